@@ -1,14 +1,15 @@
 import logging
 import json
-import sqlite3
 import asyncio
-import random
 import requests
 from datetime import datetime, timedelta
 import jdatetime
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
-from telegram.error import TelegramError
+from db import Database
+from gateway import AqayepardakhtClient
+from invoice_ids import InvoiceIdAllocator
+from membership import MembershipChecker
 
 # خواندن تنظیمات از فایل config.json
 with open('config.json', 'r', encoding='utf-8') as config_file:
@@ -18,6 +19,18 @@ API_TOKEN = config['API_TOKEN']
 DB_FILE = config['DB_FILE']
 SPONSOR_CHANNELS = config['SPONSOR_CHANNELS']
 
+# اتصال ماندگار به دیتابیس فاکتورها
+invoices_db = Database(DB_FILE)
+
+# شماره فاکتورها از همان بلوک‌های رزروی ربات اصلی گرفته می‌شوند تا تکراری نشوند
+invoice_ids = InvoiceIdAllocator(invoices_db)
+
+# کش عضویت کاربران در کانال‌های اسپانسر
+membership = MembershipChecker(SPONSOR_CHANNELS)
+
+# کلاینت مشترک درگاه پرداخت
+gateway = AqayepardakhtClient("sandbox", "http://127.0.0.1:5000/callback")
+
 # تنظیمات لاگینگ
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -38,16 +51,9 @@ def convert_to_tehran_time(utc_time_str):
     j_date = jdatetime.datetime.fromgregorian(year=tehran_time.year, month=tehran_time.month, day=tehran_time.day)
     return f"{j_date.year}/{j_date.month}/{j_date.day} {tehran_time.strftime('%H:%M:%S')}"
 
-async def check_membership(user_id, bot):
-    """بررسی عضویت کاربر در کانال‌های اسپانسر"""
-    for channel in SPONSOR_CHANNELS:
-        try:
-            member = await bot.get_chat_member(chat_id=channel['id'], user_id=user_id)
-            if member.status not in ['member', 'administrator', 'creator']:
-                return False
-        except TelegramError:
-            return False
-    return True
+async def check_membership(user_id, bot, force=False):
+    """بررسی عضویت کاربر در کانال‌های اسپانسر (از کش)"""
+    return await membership.is_member(bot, user_id, force)
 
 async def send_membership_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ارسال پیام عضویت در کانال‌ها"""
@@ -59,11 +65,9 @@ async def send_membership_message(update: Update, context: ContextTypes.DEFAULT_
         reply_markup=markup
     )
 
-def init_db():
+async def init_db():
     """ایجاد دیتابیس و جدول مربوط به فاکتورها"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
+    await invoices_db.execute("""
         CREATE TABLE IF NOT EXISTS invoices (
             invoice_id TEXT PRIMARY KEY,
             transid TEXT,
@@ -76,55 +80,32 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
-    conn.commit()
-    conn.close()
 
-def save_invoice(invoice_id, transid, amount, trx_amount, wallet, user_id, status="pending"):
+async def save_invoice(invoice_id, transid, amount, trx_amount, wallet, user_id, status="pending"):
     """ذخیره فاکتور در دیتابیس"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
+    await invoices_db.execute("""
         INSERT INTO invoices (invoice_id, transid, amount, trx_amount, wallet, user_id, status, created_at)
         VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
     """, (invoice_id, transid, amount, trx_amount, wallet, user_id, status))
-    conn.commit()
-    conn.close()
 
-def update_invoice_status(invoice_id, status):
+async def update_invoice_status(invoice_id, status):
     """به‌روزرسانی وضعیت فاکتور در دیتابیس"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE invoices SET status = ? WHERE invoice_id = ?", (status, invoice_id))
-    conn.commit()
-    conn.close()
+    await invoices_db.execute("UPDATE invoices SET status = ? WHERE invoice_id = ?", (status, invoice_id))
 
-def get_pending_invoices():
+async def get_pending_invoices():
     """گرفتن فاکتورهای معلق که بیش از 15 دقیقه از ایجادشان گذشته است"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
+    return await invoices_db.fetchall("""
         SELECT invoice_id, user_id FROM invoices
         WHERE status = 'pending' AND created_at <= datetime('now', '-15 minutes')
     """)
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
 
-def update_message_chat_id(invoice_id, message_chat_id):
+async def update_message_chat_id(invoice_id, message_chat_id):
     """به‌روزرسانی message_chat_id برای یک فاکتور"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE invoices SET message_chat_id = ? WHERE invoice_id = ?", (message_chat_id, invoice_id))
-    conn.commit()
-    conn.close()
+    await invoices_db.execute("UPDATE invoices SET message_chat_id = ? WHERE invoice_id = ?", (message_chat_id, invoice_id))
 
 async def handle_invoice_cancellation(context, invoice_id, user_id):
     """لغو فاکتور و حذف پیام مربوطه"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT message_chat_id FROM invoices WHERE invoice_id = ?", (invoice_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = await invoices_db.fetchone("SELECT message_chat_id FROM invoices WHERE invoice_id = ?", (invoice_id,))
 
     if row and row[0]:
         message_chat_id = row[0]
@@ -141,16 +122,12 @@ async def handle_invoice_cancellation(context, invoice_id, user_id):
 async def monitor_invoices(context: ContextTypes.DEFAULT_TYPE):
     """بررسی وضعیت فاکتورهای معلق و لغو آنها در صورت عدم پرداخت"""
     while True:
-        pending_invoices = get_pending_invoices()
+        pending_invoices = await get_pending_invoices()
         for invoice_id, user_id in pending_invoices:
-            update_invoice_status(invoice_id, "canceled")
+            await update_invoice_status(invoice_id, "canceled")
             await handle_invoice_cancellation(context, invoice_id, user_id)
         await asyncio.sleep(60)
 
-def generate_invoice_number():
-    """تولید شماره فاکتور 8 رقمی"""
-    return random.randint(10000000, 99999999)
-
 def get_trx_price():
     """دریافت قیمت لحظه‌ای ترون"""
     try:
@@ -180,29 +157,18 @@ async def create_invoice(chat_id, trx_amount, fee_method, wallet_address):
     elif fee_method == "fee_trx":
         amount_toman = int((trx_amount * 1.05) * trx_price)
 
-    invoice_number = generate_invoice_number()
-    data = {
-        "pin": "sandbox",
-        "amount": amount_toman,
-        "callback": "http://127.0.0.1:5000/callback",
-        "invoice_id": str(invoice_number),
-    }
+    invoice_number = await invoice_ids.next()
 
     try:
-        response = requests.post('https://panel.aqayepardakht.ir/api/v2/create', data=data)
-        json_data = response.json()
-
-        if response.status_code == 200 and json_data.get('status') == 'success':
-            payment_url = f"https://panel.aqayepardakht.ir/startpay/sandbox/{json_data['transid']}"
-            transid = json_data['transid']
-            save_invoice(invoice_number, transid, amount_toman, trx_amount, wallet_address, chat_id, "pending")
-            return payment_url, invoice_number
-        else:
-            return None, invoice_number
+        transid = await gateway.create(amount_toman, invoice_number)
     except Exception as e:
         logger.error(f"خطا در درخواست به پذیرنده: {e}")
         return None, invoice_number
 
+    payment_url = gateway.payment_url(transid)
+    await save_invoice(invoice_number, transid, amount_toman, trx_amount, wallet_address, chat_id, "pending")
+    return payment_url, invoice_number
+
 # ====== هندلرهای دستورات ======
 
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -246,7 +212,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if query.data == "check_membership":
-        is_member = await check_membership(user_id, context.bot)
+        is_member = await check_membership(user_id, context.bot, force=True)
         if is_member:
             await query.message.delete()
             await start_handler(update, context)
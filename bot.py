@@ -1,13 +1,31 @@
 import logging
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
-import requests
+from telegram.error import BadRequest
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ChatMemberHandler, MessageHandler, ContextTypes, filters
 from datetime import datetime, timedelta
-import random
-import sqlite3
+import secrets
 import asyncio
 import jdatetime
 import json
+from functools import partial
+from db import Database
+from expiry import ExpiryScheduler
+from price_service import PriceService
+from market_data import CURRENCY_NAMES, split_market
+from price_alerts import ABOVE, BELOW, PriceAlerts
+from gateway import AqayepardakhtClient
+from membership import MembershipChecker
+from users import UserCache
+from sessions import SessionStore
+from update_processor import ChatOrderedUpdateProcessor
+from webhook import run_webhook
+from payment_events import PaymentEventConsumer
+from payments import PAID
+from invoice_ids import InvoiceIdAllocator
+from outbound import BACKGROUND, PriorityRateLimiter
+import callback
+from price_history import PriceHistory
+from migrations import INVOICES_MIGRATIONS, USERS_MIGRATIONS, migrate
 
 # خواندن اطلاعات پیکربندی از فایل config.json
 with open('config.json', 'r', encoding='utf-8') as config_file:
@@ -18,9 +36,81 @@ TOKEN = config['token']
 SPONSOR_CHANNELS = config['sponsor_channels']
 DB_FILE = config['invoices']
 USERS_DB = config['users']
+INVOICE_TTL_MINUTES = config.get('invoice_ttl_minutes', 15)
+MARKETS = config.get('markets', ['trx-rls'])
+PRICE_REFRESH_SECONDS = config.get('price_refresh_seconds', 30)
+PRICE_MAX_AGE_SECONDS = config.get('price_max_age_seconds', 120)
+QUOTE_TTL_SECONDS = config.get('quote_ttl_seconds', 120)
+PRICE_HISTORY_FILE = config.get('price_history_file', 'price_history.bin')
+GATEWAY_PIN = config.get('gateway_pin', 'sandbox')
+GATEWAY_CALLBACK_URL = config.get('gateway_callback_url', 'http://127.0.0.1:5000/callback')
+MEMBERSHIP_CACHE_SECONDS = config.get('membership_cache_seconds', 600)
+USER_CACHE_SIZE = config.get('user_cache_size', 10000)
+SESSION_TTL_HOURS = config.get('session_ttl_hours', 24)
+SESSION_CACHE_SIZE = config.get('session_cache_size', 10000)
+MAX_CONCURRENT_UPDATES = config.get('max_concurrent_updates', 32)
+# با تنظیم webhook_url ربات به جای polling در حالت webhook اجرا می‌شود
+WEBHOOK_URL = config.get('webhook_url')
+WEBHOOK_LISTEN = config.get('webhook_listen', '0.0.0.0')
+WEBHOOK_PORT = config.get('webhook_port', 8443)
+WEBHOOK_SECRET = config.get('webhook_secret')
+EVENTS_SOCKET = config.get('events_socket', 'payment_events.sock')
+SEND_RATE_PER_SECOND = config.get('send_rate_per_second', 25)
+CHAT_SEND_RATE_PER_SECOND = config.get('chat_send_rate_per_second', 1)
+
+# اتصال‌های ماندگار به دیتابیس‌ها
+invoices_db = Database(DB_FILE)
+users_db = Database(USERS_DB)
+
+# کش پروفایل کاربران تا منوها برای کاربران ثبت‌نام‌شده به دیتابیس نروند
+user_cache = UserCache(users_db, max_size=USER_CACHE_SIZE)
+
+# وضعیت گفتگوی چت‌ها که بعد از ری‌استارت هم باقی می‌ماند
+sessions = SessionStore(users_db, ttl=SESSION_TTL_HOURS * 3600, max_sessions=SESSION_CACHE_SIZE)
+
+# شماره فاکتورهای یکتا (بلوک‌های رزروشده از invoices.db)
+invoice_ids = InvoiceIdAllocator(invoices_db)
+
+# کلاینت مشترک درگاه پرداخت
+gateway = AqayepardakhtClient(GATEWAY_PIN, GATEWAY_CALLBACK_URL)
+GATEWAY_UNAVAILABLE_TEXT = "⚠️ درگاه پرداخت موقتاً در دسترس نیست. لطفاً چند دقیقه دیگر دوباره تلاش کنید."
+
+# دریافت نتیجه پرداخت‌ها از سرور کالبک (رویدادها در invoices.db صف می‌شوند)
+payment_events = PaymentEventConsumer(invoices_db, EVENTS_SOCKET)
+
+# کش عضویت کاربران در کانال‌های اسپانسر
+membership = MembershipChecker(SPONSOR_CHANNELS, member_ttl=MEMBERSHIP_CACHE_SECONDS)
+
+# زمان‌بند لغو خودکار فاکتورهای پرداخت‌نشده
+expiry_scheduler = ExpiryScheduler(invoices_db, ttl_seconds=INVOICE_TTL_MINUTES * 60)
+
+# قیمت ترون که در پس‌زمینه به‌روز می‌شود
+price_service = PriceService(
+    markets=['trx-rls', *MARKETS], refresh_interval=PRICE_REFRESH_SECONDS, max_age=PRICE_MAX_AGE_SECONDS, quote_ttl=QUOTE_TTL_SECONDS
+)
+
+# پاسخ وقتی قیمت قفل‌شده پیش از صدور فاکتور منقضی شده باشد
+QUOTE_EXPIRED_TEXT = "⌛ قیمت قفل‌شده منقضی شده است. لطفاً دوباره روش پرداخت کارمزد را انتخاب کنید تا قیمت جدید دریافت شود."
+
+# تاریخچه قیمت‌های دریافت‌شده برای آمار دکمه قیمت
+price_history = PriceHistory()
+price_service.add_listener(price_history.append)
+
+def format_alert_message(market, direction, threshold, price):
+    """متن پیام فعال شدن هشدار قیمت"""
+    src, dst = split_market(market)
+    unit = "تومان" if dst == "rls" else dst.upper()
+    condition = "بالاتر از" if direction == ABOVE else "پایین‌تر از"
+    return (
+        f"🔔 هشدار قیمت {CURRENCY_NAMES.get(src, src.upper())}\n\n"
+        f"قیمت به {format_price(price)} {unit} رسید ({condition} {format_price(threshold)} {unit})."
+    )
+
+# هشدارهای قیمت کاربران که با هر قیمت جدید ارزیابی می‌شوند
+price_alerts = PriceAlerts(users_db, format_alert_message, rate_limit_args=BACKGROUND)
+for market in price_service.markets:
+    price_service.add_listener(partial(price_alerts.on_price, market), market)
 
-# ذخیره داده‌های کاربران
-user_data = {}
 
 # تنظیمات لاگینگ
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -28,15 +118,29 @@ logger = logging.getLogger(__name__)
 
 # ====== توابع کمکی ======
 
-async def check_membership(bot, user_id):
-    for channel in SPONSOR_CHANNELS:
+async def check_membership(bot, user_id, force=False):
+    return await membership.is_member(bot, user_id, force)
+
+async def edit_or_send(bot, chat_id, message, text, reply_markup=None):
+    """
+    نمایش مرحله بعد گفتگو با ویرایش پیام قبلی ربات (Message یا message_id)
+    اگر متن تغییری نکرده باشد فقط دکمه‌ها ویرایش می‌شوند و اگر ویرایش ممکن نباشد (پیام حذف شده
+    یا قابل ویرایش نیست) پیام جدید ارسال می‌شود. خروجی message_id پیام نمایش‌داده‌شده است.
+    """
+    message_id = getattr(message, "message_id", message)
+    if message_id:
         try:
-            member = await bot.get_chat_member(chat_id=channel['id'], user_id=user_id)
-            if member.status not in ['member', 'administrator', 'creator']:
-                return False
-        except Exception:
-            return False
-    return True
+            if getattr(message, "text", None) == text:
+                await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+            else:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=reply_markup)
+            return message_id
+        except BadRequest as e:
+            if "not modified" in e.message:
+                return message_id
+            logger.warning(f"ویرایش پیام {message_id} ممکن نشد: {e}")
+    message = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+    return message.message_id
 
 async def send_sponsor_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = []
@@ -54,6 +158,30 @@ def format_price(price):
     """فرمت مبلغ با کاما"""
     return "{:,}".format(price)
 
+def format_price_stats(title, seconds):
+    """متن آمار قیمت یک بازه از تاریخچه قیمت"""
+    stats = price_history.stats(seconds)
+    if not stats:
+        return ""
+    sign = "+" if stats['change'] >= 0 else ""
+    return (
+        f"\n\n📈 {title}:\n"
+        f"کمترین: {format_price(stats['min'])} | بیشترین: {format_price(stats['max'])}\n"
+        f"تغییر: {sign}{stats['change']:.2f}٪ {price_history.sparkline(seconds)}"
+    )
+
+def format_market_prices():
+    """قیمت سایر بازارهای پیکربندی‌شده از جدول بازار"""
+    lines = []
+    for market in MARKETS:
+        ticker = price_service.tickers.get(market)
+        if market == 'trx-rls' or ticker is None:
+            continue
+        src, dst = split_market(market)
+        unit = "تومان" if dst == "rls" else dst.upper()
+        lines.append(f"💱 {CURRENCY_NAMES.get(src, src.upper())}: {format_price(ticker.best_buy)} {unit}")
+    return "\n\n" + "\n".join(lines) if lines else ""
+
 def convert_to_tehran_time(utc_time_str):
     """تبدیل زمان UTC به وقت تهران و فرمت شمسی"""
     utc_time = datetime.strptime(utc_time_str, "%Y-%m-%d %H:%M:%S")
@@ -63,62 +191,91 @@ def convert_to_tehran_time(utc_time_str):
     j_date = jdatetime.datetime.fromgregorian(year=tehran_time.year, month=tehran_time.month, day=tehran_time.day)
     return f"{j_date.year}/{j_date.month}/{j_date.day} {tehran_time.strftime('%H:%M:%S')}"  # فرمت تاریخ شمسی
 
-async def list_transactions_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+TRANSACTIONS_PER_PAGE = 6
+
+async def fetch_transactions_page(user_id, cursor=None, direction="next"):
+    """
+    گرفتن یک صفحه از تراکنش‌های کاربر با صفحه‌بندی keyset روی (created_at, invoice_id)
+    یک سطر بیشتر از اندازه صفحه خوانده می‌شود تا وجود صفحه بعدی (یا قبلی) مشخص شود.
+    خروجی: (سطرها به ترتیب جدید به قدیم، صفحه قبلی دارد، صفحه بعدی دارد)
+    """
+    limit = TRANSACTIONS_PER_PAGE + 1
+    if cursor is None:
+        rows = await invoices_db.fetchall("""
+            SELECT invoice_id, status, created_at FROM invoices
+            WHERE user_id = ?
+            ORDER BY created_at DESC, invoice_id DESC LIMIT ?
+        """, (user_id, limit))
+        return rows[:TRANSACTIONS_PER_PAGE], False, len(rows) > TRANSACTIONS_PER_PAGE
+
+    created_at, invoice_id = cursor
+    if direction == "next":
+        rows = await invoices_db.fetchall("""
+            SELECT invoice_id, status, created_at FROM invoices
+            WHERE user_id = ? AND (created_at, invoice_id) < (?, ?)
+            ORDER BY created_at DESC, invoice_id DESC LIMIT ?
+        """, (user_id, created_at, invoice_id, limit))
+        return rows[:TRANSACTIONS_PER_PAGE], True, len(rows) > TRANSACTIONS_PER_PAGE
+
+    rows = await invoices_db.fetchall("""
+        SELECT invoice_id, status, created_at FROM invoices
+        WHERE user_id = ? AND (created_at, invoice_id) > (?, ?)
+        ORDER BY created_at ASC, invoice_id ASC LIMIT ?
+    """, (user_id, created_at, invoice_id, limit))
+    return list(reversed(rows[:TRANSACTIONS_PER_PAGE])), len(rows) > TRANSACTIONS_PER_PAGE, True
+
+def transactions_page_callback(direction, row):
+    """ساخت callback_data دکمه‌های ناوبری؛ مکان‌نما (created_at, invoice_id) داخل خود دکمه است"""
+    invoice_id, _, created_at = row
+    return f"tx_{direction}|{created_at}|{invoice_id}"
+
+def parse_transactions_page_callback(data):
+    """استخراج جهت و مکان‌نما از callback_data دکمه‌های ناوبری"""
+    prefix, created_at, invoice_id = data.split("|", 2)
+    return prefix[len("tx_"):], (created_at, invoice_id)
+
+async def list_transactions_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, cursor=None, direction="next"):
     user_id = update.effective_chat.id
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT invoice_id, status, created_at FROM invoices WHERE user_id = ?", (user_id,))
-    transactions = cursor.fetchall()
-    conn.close()
-    
-    total_transactions = len(transactions)
-    if total_transactions == 0:
+    transactions_to_display, has_prev, has_next = await fetch_transactions_page(user_id, cursor, direction)
+
+    if not transactions_to_display and cursor is None:
         await update.callback_query.answer()
-        await update.callback_query.message.reply_text("شما هیچ تراکنشی ندارید.")
+        await edit_or_send(context.bot, user_id, update.callback_query.message, "شما هیچ تراکنشی ندارید.")
         return
 
-    page = int(context.user_data.get(f'page_{user_id}', 0))
-    items_per_page = 6
-    start_index = page * items_per_page
-    end_index = start_index + items_per_page
-
-    transactions_sorted = sorted(transactions, key=lambda x: x[2], reverse=True)
-    transactions_to_display = transactions_sorted[start_index:end_index]
-
     keyboard = []
     for i in range(0, len(transactions_to_display), 2):
         row_buttons = []
         for j in range(2):
             if i + j < len(transactions_to_display):
                 invoice_id, status, _ = transactions_to_display[i + j]
-                button_text = f"🔴 {invoice_id}" if status == 'canceled' else f"🟡 {invoice_id}" if status == 'pending' else f"🟢 {invoice_id}"
+                button_text = f"🔴 {invoice_id}" if status in ('canceled', 'failed') else f"🟡 {invoice_id}" if status == 'pending' else f"🟢 {invoice_id}"
                 row_buttons.append(InlineKeyboardButton(button_text, callback_data=f"view_{invoice_id}"))
         if row_buttons:
             keyboard.append(row_buttons)
 
     navigation_buttons = []
-    if page > 0:
-        navigation_buttons.append(InlineKeyboardButton("صفحه قبل ⬅️", callback_data="prev_page"))
-    if end_index < total_transactions:
-        navigation_buttons.append(InlineKeyboardButton("صفحه بعد ➡️", callback_data="next_page"))
+    if has_prev and transactions_to_display:
+        navigation_buttons.append(InlineKeyboardButton("صفحه قبل ⬅️", callback_data=transactions_page_callback("prev", transactions_to_display[0])))
+    if has_next and transactions_to_display:
+        navigation_buttons.append(InlineKeyboardButton("صفحه بعد ➡️", callback_data=transactions_page_callback("next", transactions_to_display[-1])))
 
     if navigation_buttons:
         keyboard.append(navigation_buttons)
 
     markup = InlineKeyboardMarkup(keyboard)
     await update.callback_query.answer()
-    await update.callback_query.message.reply_text("🧾 لیست تراکنش‌های شما:", reply_markup=markup)
+    # با جابه‌جایی بین صفحه‌ها فقط دکمه‌های همان پیام عوض می‌شوند
+    await edit_or_send(context.bot, user_id, update.callback_query.message, "🧾 لیست تراکنش‌های شما:", markup)
 
 async def view_transaction_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """مدیریت جزئیات تراکنش"""
     invoice_id = update.callback_query.data.split("_")[1]  # استخراج invoice_id از callback_data
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
+
     # دریافت جزئیات تراکنش
-    cursor.execute("SELECT transid, amount, trx_amount, wallet, status, created_at FROM invoices WHERE invoice_id = ?", (invoice_id,))
-    transaction = cursor.fetchone()
-    conn.close()
+    transaction = await invoices_db.fetchone(
+        "SELECT transid, amount, trx_amount, wallet, status, created_at FROM invoices WHERE invoice_id = ?", (invoice_id,)
+    )
     
     if transaction:
         transid, amount, trx_amount, wallet, status, created_at = transaction
@@ -127,8 +284,8 @@ async def view_transaction_handler(update: Update, context: ContextTypes.DEFAULT
         created_at_tehran = convert_to_tehran_time(created_at)
         
         # وضعیت تراکنش
-        status_icon = "🔴" if status == "canceled" else "🟢" if status == "paid" else "🟡"
-        status_text = "لغو شده" if status == "canceled" else "موفق" if status == "paid" else "معلق"
+        status_icon = "🔴" if status in ("canceled", "failed") else "🟢" if status == "paid" else "🟡"
+        status_text = "لغو شده" if status == "canceled" else "ناموفق" if status == "failed" else "موفق" if status == "paid" else "معلق"
         
         response_text = f"✅ جزئیات تراکنش شما با شماره {invoice_id}:\n\n" \
                         f"کد تراکنش: {transid}\n" \
@@ -145,72 +302,19 @@ async def view_transaction_handler(update: Update, context: ContextTypes.DEFAULT
         await update.callback_query.answer()
         await update.callback_query.message.reply_text("تراکنش یافت نشد.")
 
-async def navigation_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """مدیریت ناوبری بین صفحات"""
-    user_id = update.effective_chat.id
-    current_page = int(context.user_data.get(f'page_{user_id}', 0))
-
-    if update.callback_query.data == "next_page":
-        context.user_data[f'page_{user_id}'] = current_page + 1
-    elif update.callback_query.data == "prev_page":
-        context.user_data[f'page_{user_id}'] = current_page - 1
-
-    await list_transactions_handler(update, context)
-
-def init_db():
-    """ایجاد دیتابیس و جدول مربوط به فاکتورها"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS invoices (
-            invoice_id TEXT PRIMARY KEY,
-            transid TEXT,
-            amount INTEGER,
-            trx_amount REAL,
-            wallet TEXT,
-            user_id INTEGER,
-            status TEXT,
-            message_chat_id INTEGER
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-
-def init_user_db():
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        role INTEGER DEFAULT 1,
-        phone_number TEXT,
-        card_number TEXT
+async def save_invoice(invoice_id, transid, amount, trx_amount, wallet, user_id, quote, status="pending", idempotency_key=None):
+    """ذخیره فاکتور در دیتابیس همراه با قیمتی که مبلغ از آن محاسبه شده است"""
+    await invoices_db.execute("""
+        INSERT INTO invoices (invoice_id, transid, amount, trx_amount, wallet, user_id, status, quote_id, trx_price, idempotency_key, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    """, (invoice_id, transid, amount, trx_amount, wallet, user_id, status, quote.quote_id, quote.price, idempotency_key))
+
+async def cancel_pending_invoice(invoice_id):
+    """لغو فاکتور به درخواست کاربر؛ فاکتوری که در این فاصله پرداخت یا لغو شده تغییر نمی‌کند"""
+    rowcount = await invoices_db.execute(
+        "UPDATE invoices SET status = 'canceled' WHERE invoice_id = ? AND status = 'pending'", (invoice_id,)
     )
-    ''')
-    conn.commit()
-    conn.close()
-
-
-def save_invoice(invoice_id, transid, amount, trx_amount, wallet, user_id, status="pending"):
-    """ذخیره فاکتور در دیتابیس"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO invoices (invoice_id, transid, amount, trx_amount, wallet, user_id, status, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-    """, (invoice_id, transid, amount, trx_amount, wallet, user_id, status))
-    conn.commit()
-    conn.close()
-
-def update_invoice_status(invoice_id, status):
-    """به‌روزرسانی وضعیت فاکتور در دیتابیس"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE invoices SET status = ? WHERE invoice_id = ?", (status, invoice_id))
-    conn.commit()
-    conn.close()
+    return rowcount > 0
 
 async def edit_card_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.callback_query.from_user.id
@@ -220,96 +324,89 @@ async def edit_card_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("❌ لغو", callback_data="cancel")]
     ])
     
-    await update.callback_query.message.reply_text(
+    prompt_message_id = await edit_or_send(
+        context.bot,
+        update.effective_chat.id,
+        update.callback_query.message,
         "☑️ لطفاً شماره کارت 16 رقمی جدید خود را ارسال نمایید:\n"
         "(حتماً صاحب حساب با شماره موبایل تطابق داشته باشد.)",
-        reply_markup=markup
+        markup
     )
     
-    context.user_data['registration_step'] = 'edit_card'
-
-
-def get_pending_invoices():
-    """گرفتن فاکتورهای معلق که بیش از 15 دقیقه از ایجادشان گذشته است"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT invoice_id, user_id FROM invoices
-        WHERE status = 'pending' AND created_at <= datetime('now', '-1 minutes')
-    """)
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
-
-def update_message_chat_id(invoice_id, message_chat_id):
+    await sessions.reset(update.effective_chat.id, "edit_card", prompt_message_id=prompt_message_id)
+
+
+async def update_message_chat_id(invoice_id, message_chat_id):
     """به‌روزرسانی message_chat_id برای یک فاکتور"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE invoices SET message_chat_id = ? WHERE invoice_id = ?", (message_chat_id, invoice_id))
-    conn.commit()
-    conn.close()
-
-async def handle_invoice_cancellation(context, invoice_id, user_id):
-    """لغو فاکتور و حذف پیام مربوطه"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT message_chat_id FROM invoices WHERE invoice_id = ?", (invoice_id,))
-    row = cursor.fetchone()
-    conn.close()
-
-    if row and row[0]:
-        message_chat_id = row[0]
+    await invoices_db.execute("UPDATE invoices SET message_chat_id = ? WHERE invoice_id = ?", (message_chat_id, invoice_id))
+
+async def handle_invoice_cancellation(bot, invoice_id, user_id, message_chat_id):
+    """حذف پیام فاکتور لغوشده و اطلاع به کاربر"""
+    if message_chat_id:
         logger.info(f"پیام با ID {message_chat_id} برای حذف پیدا شد.")
         try:
             # حذف پیام
-            await context.bot.delete_message(chat_id=user_id, message_id=message_chat_id)
+            await bot.delete_message(chat_id=user_id, message_id=message_chat_id, rate_limit_args=BACKGROUND)
         except Exception as e:
             logger.error(f"خطا در حذف پیام برای کاربر {user_id}: {e}")
     else:
         logger.warning(f"پیام با ID {invoice_id} پیدا نشد یا message_chat_id خالی است.")
 
-    if row and row[0]:
-        message_chat_id = row[0]
-        try:
-            # حذف پیام
-            await context.bot.delete_message(chat_id=user_id, message_id=message_chat_id)
-        except Exception as e:
-            logger.error(f"خطا در حذف پیام برای کاربر {user_id}: {e}")
-
     # ارسال پیام لغو به کاربر
-    await context.bot.send_message(
+    await bot.send_message(
         chat_id=user_id,
-        text=f"❌ کاربر گرامی، سفارش شما با شماره {invoice_id} به دلیل عدم پرداخت فاکتور بعد از ۱۵ دقیقه لغو شد."
+        text=f"❌ کاربر گرامی، سفارش شما با شماره {invoice_id} به دلیل عدم پرداخت فاکتور بعد از {INVOICE_TTL_MINUTES} دقیقه لغو شد.",
+        rate_limit_args=BACKGROUND,
+    )
+
+async def handle_payment_event(bot, invoice_id, status):
+    """به‌روزرسانی پیام فاکتور و اطلاع به کاربر پس از ثبت نتیجه پرداخت در کالبک"""
+    invoice = await invoices_db.fetchone(
+        "SELECT user_id, message_chat_id, trx_amount, wallet FROM invoices WHERE invoice_id = ?", (invoice_id,)
     )
+    if invoice is None:
+        return
+    user_id, message_chat_id, trx_amount, wallet = invoice
+
+    # کاربر از حالت انتظار پرداخت همین فاکتور خارج می‌شود
+    if str((await sessions.get(user_id)).invoice_id) == str(invoice_id):
+        await sessions.reset(user_id)
+
+    if status == PAID:
+        text = (
+            f"✅ پرداخت فاکتور شماره {invoice_id} با موفقیت انجام شد.\n\n"
+            f"🔹 مقدار ترون: {trx_amount}\n"
+            f"🔹 آدرس ولت: {wallet}\n\n"
+            f"ترون شما به‌زودی به آدرس ولت ارسال می‌شود."
+        )
+    else:
+        text = f"❌ پرداخت فاکتور شماره {invoice_id} ناموفق بود. در صورت کسر وجه، مبلغ به حساب شما بازمی‌گردد."
+
+    # پیام فاکتور (با دکمه پرداخت) با نتیجه جایگزین می‌شود؛ اگر پیام حذف شده باشد پیام جدید ارسال می‌شود
+    if message_chat_id:
+        try:
+            await bot.edit_message_text(chat_id=user_id, message_id=message_chat_id, text=text)
+            return
+        except Exception as e:
+            logger.warning(f"ویرایش پیام فاکتور {invoice_id} ممکن نشد: {e}")
+    await bot.send_message(chat_id=user_id, text=text)
 
 # ====== زمان‌بندی ======
-async def monitor_invoices(context: ContextTypes.DEFAULT_TYPE):
-    """بررسی وضعیت فاکتورهای معلق و لغو آنها در صورت عدم پرداخت"""
-    while True:
-        pending_invoices = get_pending_invoices()
-        for invoice_id, user_id in pending_invoices:
-            update_invoice_status(invoice_id, "canceled")
-            await handle_invoice_cancellation(context, invoice_id, user_id)
-        await asyncio.sleep(60)  # هر 60 ثانیه بررسی انجام شود
-
-def generate_invoice_number():
-    """تولید شماره فاکتور 8 رقمی"""
-    return random.randint(10000000, 99999999)
-
-def get_trx_price():
-    """دریافت قیمت لحظه‌ای ترون"""
-    try:
-        url = "https://api.nobitex.ir/market/stats?srcCurrency=trx&dstCurrency=rls"
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            best_buy_price = int(data['stats']['trx-rls']['bestBuy']) // 10
-            return best_buy_price
-        else:
-            raise Exception("API Error")
-    except Exception as e:
-        logger.error(f"Error fetching TRX price: {e}")
-        return None
+async def notify_expired_invoices(bot, expired):
+    """اطلاع‌رسانی فاکتورهایی که زمان‌بند انقضا لغو کرده است"""
+    for invoice_id, user_id, message_chat_id in expired:
+        # کاربر از حالت انتظار پرداخت خارج می‌شود تا بتواند خرید جدید ثبت کند
+        # invoice_id جلسه عددی و خروجی زمان‌بند متنی است
+        if str((await sessions.get(user_id)).invoice_id) == str(invoice_id):
+            await sessions.reset(user_id)
+        try:
+            await handle_invoice_cancellation(bot, invoice_id, user_id, message_chat_id)
+        except Exception as e:
+            logger.error(f"خطا در ارسال پیام لغو فاکتور {invoice_id}: {e}")
+
+async def get_trx_price():
+    """دریافت قیمت لحظه‌ای ترون از کش سرویس قیمت (None اگر قیمت تازه‌ای در دسترس نباشد)"""
+    return await price_service.get_price()
 
 def format_price(price):
     return "{:,}".format(price)
@@ -317,8 +414,8 @@ def format_price(price):
 # ====== هندلرهای دستورات ======
 
 
-async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """مدیریت دستور /start"""
+async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, notice=None):
+    """مدیریت دستور /start؛ notice بالای منوی اصلی نمایش داده می‌شود"""
     # تشخیص نوع آپدیت (پیام یا دکمه)
     if update.message:
         chat_id = update.effective_chat.id
@@ -337,15 +434,11 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
   # بررسی وجود کاربر در دیتابیس
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    user = await user_cache.get(user_id)
     
     if user is None:
         # کاربر جدید است، شروع فرآیند احراز هویت
-        context.user_data['status'] = 'phone'
+        await sessions.reset(chat_id, "phone")
         keyboard = [[KeyboardButton("ارسال شماره تماس", request_contact=True)]]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
         await update.message.reply_text(
@@ -354,7 +447,7 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     else:
         # کاربر قبلاً ثبت‌نام کرده است، نمایش منوی اصلی
-        await show_main_menu(update, context)
+        await show_main_menu(update, context, notice)
     
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     contact = update.message.contact
@@ -366,8 +459,7 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ شماره تماس باید با پیش‌شماره +98 شروع شود. لطفاً شماره صحیح را وارد کنید.")
         return
 
-    context.user_data['phone_number'] = contact.phone_number
-    context.user_data['status'] = 'card'
+    await sessions.reset(update.effective_chat.id, "card", phone_number=contact.phone_number)
     await update.message.reply_text(
         "☑️ لطفاً شماره کارت 16رقمی خود را ارسال نمایید:\n"
         "(حتماً صاحب حساب با شماره موبایل تطابق داشته باشد.)",
@@ -381,21 +473,71 @@ async def handle_card_number(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     user_id = update.effective_user.id
-    phone_number = context.user_data['phone_number']
+    phone_number = (await sessions.get(update.effective_chat.id)).phone_number
     
     # ذخیره اطلاعات کاربر در دیتابیس
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO users (user_id, phone_number, card_number) VALUES (?, ?, ?)",
-                   (user_id, phone_number, card_number))
-    conn.commit()
-    conn.close()
+    await user_cache.register(user_id, phone_number, card_number)
     
-    del context.user_data['status']
+    await sessions.reset(update.effective_chat.id)
     await update.message.reply_text("✅ ثبت‌نام شما با موفقیت انجام شد.")
     await show_main_menu(update, context)
 
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def price_alerts_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, notice=None):
+    """نمایش هشدارهای فعال کاربر و دکمه‌های ثبت هشدار جدید"""
+    user_id = update.effective_user.id
+    alerts = await price_alerts.user_alerts(user_id)
+
+    keyboard = []
+    for alert_id, market, direction, threshold in alerts:
+        condition = "بالاتر از" if direction == ABOVE else "پایین‌تر از"
+        keyboard.append([InlineKeyboardButton(f"❌ {condition} {format_price(threshold)}", callback_data=f"alert_del_{alert_id}")])
+    keyboard.append([
+        InlineKeyboardButton("📈 بالاتر از", callback_data="alert_above"),
+        InlineKeyboardButton("📉 پایین‌تر از", callback_data="alert_below")
+    ])
+
+    text = "🔔 هشدارهای قیمت ترون شما:" if alerts else "🔔 شما هیچ هشدار قیمت فعالی ندارید."
+    if notice:
+        text = f"{notice}\n\n{text}"
+    await edit_or_send(
+        context.bot,
+        update.effective_chat.id,
+        update.callback_query.message,
+        text + "\n\nبا زدن روی هر هشدار، آن هشدار حذف می‌شود. برای ثبت هشدار جدید نوع آن را انتخاب کنید:",
+        InlineKeyboardMarkup(keyboard)
+    )
+
+async def handle_alert_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ثبت هشدار قیمت با قیمت هدف واردشده توسط کاربر"""
+    text = update.message.text.replace(",", "").replace("٬", "").strip()
+    if not text.isdigit():
+        await update.message.reply_text("❌ لطفاً قیمت هدف را به‌صورت عدد وارد کنید.")
+        return
+
+    threshold = int(text)
+    direction = (await sessions.get(update.effective_chat.id)).alert_direction or ABOVE
+    current_price = price_service.price
+    if current_price is not None and (
+        (direction == ABOVE and threshold <= current_price) or (direction == BELOW and threshold >= current_price)
+    ):
+        await update.message.reply_text(
+            f"❌ قیمت فعلی ترون {format_price(current_price)} تومان است. "
+            f"قیمت هدف باید {'بیشتر' if direction == ABOVE else 'کمتر'} از قیمت فعلی باشد."
+        )
+        return
+
+    await sessions.reset(update.effective_chat.id)
+    alert_id = await price_alerts.add(update.effective_user.id, 'trx-rls', direction, threshold)
+    if alert_id is None:
+        await update.message.reply_text(f"❌ حداکثر {price_alerts.max_alerts_per_user} هشدار فعال می‌توانید داشته باشید.")
+    else:
+        condition = "بالاتر از" if direction == ABOVE else "پایین‌تر از"
+        await update.message.reply_text(
+            f"✅ هشدار ثبت شد. وقتی قیمت ترون {condition} {format_price(threshold)} تومان شود به شما اطلاع می‌دهیم."
+        )
+    await show_main_menu(update, context)
+
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, notice=None):
     # بررسی نوع آپدیت
     if update.message:
         chat_id = update.effective_chat.id
@@ -417,100 +559,159 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ],
     ])
 
-    # ارسال پیام به کاربر
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text="به ربات خوش آمدید! لطفاً از منوی زیر انتخاب کنید:",
-        reply_markup=markup
-    )
+    text = "به ربات خوش آمدید! لطفاً از منوی زیر انتخاب کنید:"
+    if notice:
+        text = f"{notice}\n\n{text}"
+
+    if update.callback_query:
+        # منو جای پیامی که دکمه آن زده شده نمایش داده می‌شود
+        await edit_or_send(context.bot, chat_id, update.callback_query.message, text, markup)
+    else:
+        await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=markup)
+
+async def get_card_number(user_id):
+    """گرفتن شماره کارت کاربر از کش پروفایل"""
+    user = await user_cache.get(user_id)
+    return user.card_number if user else None
+
+def calculate_invoice_amount(trx_amount, fee_method, trx_price):
+    """محاسبه مبلغ فاکتور به تومان بر اساس روش پرداخت کارمزد"""
+    if fee_method == "fee_toman":
+        return int((trx_amount * 1.05 + 1.5) * trx_price)  # با اضافه‌کردن کارمزد
+    elif fee_method == "fee_trx":
+        return int((trx_amount * 1.05) * trx_price)
+    return int(trx_amount * trx_price)  # مبلغ کل به تومان
 
-def get_card_number(user_id):
-    """گرفتن شماره کارت کاربر از دیتابیس"""
-    conn = sqlite3.connect(USERS_DB)
-    cursor = conn.cursor()
-    cursor.execute("SELECT card_number FROM users WHERE user_id = ?", (user_id,))
-    card_number = cursor.fetchone()
-    conn.close()
-    return card_number[0] if card_number else Non
+# صدور فاکتورهای در حال انجام هر کاربر: user_id -> (purchase_key, future)
+invoice_creations = {}
 
-async def create_invoice(chat_id, trx_amount, fee_method, wallet_address):
+async def create_invoice(chat_id, trx_amount, fee_method, wallet_address, quote, purchase_key):
+    """
+    صدور فاکتور یک خرید؛ خروجی (payment_url, invoice_number, created)
+    اگر قیمت قفل‌شده پیش از صدور منقضی شود invoice_number برابر None است.
+    هر کاربر در هر لحظه فقط یک صدور در جریان دارد. فشردن دوباره دکمه برای همان خرید به
+    صدور در جریان می‌پیوندد و اگر فاکتور این خرید قبلاً صادر شده باشد همان فاکتور با
+    created=False برمی‌گردد، پس یک خرید هیچ‌وقت دو بار به درگاه نمی‌رود.
+    """
+    while True:
+        inflight = invoice_creations.get(chat_id)
+        if inflight is None:
+            break
+        key, future = inflight
+        if key == purchase_key:
+            payment_url, invoice_number, _ = await asyncio.shield(future)
+            return payment_url, invoice_number, False
+        await asyncio.wait([future])
+
+    future = asyncio.ensure_future(
+        issue_invoice(chat_id, trx_amount, fee_method, wallet_address, quote, purchase_key)
+    )
+    invoice_creations[chat_id] = (purchase_key, future)
+    future.add_done_callback(lambda _: invoice_creations.pop(chat_id, None))
+    return await asyncio.shield(future)
+
+async def issue_invoice(chat_id, trx_amount, fee_method, wallet_address, quote, purchase_key):
     """
     ارسال درخواست به پذیرنده برای صدور فاکتور
+    مبلغ از همان quote محاسبه می‌شود که به کاربر نمایش داده شده است.
     """
-    # محاسبه مبلغ به تومان
-    trx_price = get_trx_price()
-    if not trx_price:
-        return None, "خطا در دریافت قیمت ترون"
+    existing = await invoices_db.fetchone(
+        "SELECT invoice_id, transid FROM invoices WHERE idempotency_key = ?", (purchase_key,)
+    )
+    if existing:
+        return gateway.payment_url(existing[1]), str(existing[0]), False
 
-    amount_toman = int(trx_amount * trx_price)  # مبلغ کل به تومان
-    if fee_method == "fee_toman":
-        amount_toman = int((trx_amount * 1.05 + 1.5) * trx_price)  # با اضافه‌کردن کارمزد
-    
-    elif fee_method == "fee_trx":
-        amount_toman = int((trx_amount * 1.05) * trx_price)
+    if quote.is_expired():
+        return None, None, False
+
+    # محاسبه مبلغ به تومان
+    amount_toman = calculate_invoice_amount(trx_amount, fee_method, quote.price)
 
     user_id = chat_id 
-    card_number = get_card_number(user_id)
-
-    # داده‌های درخواست
-    invoice_number = generate_invoice_number()  # شماره فاکتور
-    data = {
-        "pin": "sandbox",  # مقدار PIN واقعی را وارد کنید
-        "amount": amount_toman,
-        "callback": "http://127.0.0.1:5000/callback",
-        "invoice_id": str(invoice_number),
-        "card_number": card_number
-    }
+    card_number = await get_card_number(user_id)
+
+    # شماره فاکتور؛ مثل ستون invoice_id متنی برگردانده می‌شود تا با مسیر تکرار یکی باشد
+    invoice_number = str(await invoice_ids.next())
 
     # ارسال درخواست به API پذیرنده
     try:
-        response = requests.post('https://panel.aqayepardakht.ir/api/v2/create', data=data)
-        json_data = response.json()
-
-        if response.status_code == 200 and json_data.get('status') == 'success':
-            payment_url = f"https://panel.aqayepardakht.ir/startpay/sandbox/{json_data['transid']}"
-            transid = json_data['transid']
-            # ذخیره فاکتور در دیتابیس
-            save_invoice(invoice_number, transid, amount_toman, trx_amount, wallet_address, chat_id, "pending")
-            return payment_url, invoice_number
-        else:
-            return None, invoice_number
+        transid = await gateway.create(amount_toman, invoice_number, card_number)
     except Exception as e:
         logger.error(f"خطا در درخواست به پذیرنده: {e}")
-        return None, invoice_number
+        return None, invoice_number, False
+
+    payment_url = gateway.payment_url(transid)
+    # ذخیره فاکتور در دیتابیس
+    await save_invoice(invoice_number, transid, amount_toman, trx_amount, wallet_address, chat_id, quote, "pending", purchase_key)
+    expiry_scheduler.schedule(invoice_number)
+    return payment_url, invoice_number, True
+
+async def reply_existing_invoice(bot, chat_id, invoice_id):
+    """نمایش دوباره فاکتوری که برای همین خرید صادر شده است در همان پیام فاکتور"""
+    invoice = await invoices_db.fetchone(
+        "SELECT transid, status, amount, trx_amount, wallet, message_chat_id FROM invoices WHERE invoice_id = ?", (invoice_id,)
+    )
+    if invoice is None or invoice[1] != 'pending':
+        await bot.send_message(
+            chat_id=chat_id, text=f"❌ فاکتور شماره {invoice_id} دیگر قابل پرداخت نیست. لطفاً دوباره از منوی اصلی اقدام کنید."
+        )
+        return
+    transid, _, amount, trx_amount, wallet, message_chat_id = invoice
+    markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("💳 پرداخت فاکتور", url=gateway.payment_url(transid))],
+        [InlineKeyboardButton("❌ لغو", callback_data="cancel_invoice")]
+    ])
+    # پیام فاکتور ویرایش می‌شود تا فقط یک پیام با دکمه پرداخت وجود داشته باشد
+    message_id = await edit_or_send(
+        bot,
+        chat_id,
+        message_chat_id,
+        f"ℹ️ فاکتور شماره {invoice_id} برای این خرید قبلاً صادر شده است و در انتظار پرداخت است:\n\n"
+        f"🔹 مقدار ترون: {trx_amount}\n"
+        f"🔹 آدرس ولت: {wallet}\n\n"
+        f"💳 مبلغ قابل پرداخت: {format_price(amount)} تومان",
+        markup
+    )
+    if str(message_id) != str(message_chat_id):
+        await update_message_chat_id(invoice_id, message_id)
 
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """مدیریت دکمه‌ها"""
     query = update.callback_query
     await query.answer()
 
-    user_status = user_data.get(query.message.chat.id, {}).get("status", "idle")
+    chat_id = query.message.chat.id
+    session = await sessions.get(chat_id)
 
     if query.data == "price_trx":
-        trx_price = get_trx_price()
+        trx_price = await get_trx_price()
         if trx_price:
             formatted_price = format_price(trx_price)
-            current_time = datetime.now().strftime("%H:%M")
+            current_time = price_service.updated_at.strftime("%H:%M")
             await query.message.reply_text(
                 f"📊 قیمت هر واحد ترون: {formatted_price} تومان\n🕘 آخرین بروزرسانی: ساعت {current_time}"
+                + format_price_stats("۱ ساعت اخیر", 3600)
+                + format_price_stats("۲۴ ساعت اخیر", 24 * 3600)
+                + format_market_prices(),
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔔 هشدار قیمت", callback_data="alerts")]])
             )
         else:
-            await query.message.reply_text(
-                "خطا در دریافت قیمت از API. لطفاً دوباره تلاش کنید."
-            )
-            await query.message.delete()
+            await edit_or_send(context.bot, chat_id, query.message, "خطا در دریافت قیمت از API. لطفاً دوباره تلاش کنید.")
 
     elif query.data == "buy_trx":
-        if user_status not in ["idle"]:
+        if session.status != "idle":
             await query.message.reply_text("❌ شما در حال انجام عملیات دیگری هستید. لطفاً ابتدا عملیات را لغو کنید.")
         else:
-            user_data[query.message.chat.id] = {"status": "reading_rules"}
+            await sessions.reset(chat_id, "reading_rules")
             markup = InlineKeyboardMarkup([
                 [InlineKeyboardButton("✅ قوانین را مطالعه و تایید می‌کنم", callback_data="accept_rules")]
             ])
-            await query.message.reply_text(
+            await edit_or_send(
+                context.bot,
+                chat_id,
+                query.message,
                 "نکات مهم در خرید:\n\n"
-                "🔹 بعد از صدور فاکتور فقط ۱۵دقیقه امکان پرداخت وجود دارد، بعد از آن منقضی و درصورت پرداخت نیز وجه به حساب شما باز خواهد گشت.\n"
+                f"🔹 بعد از صدور فاکتور فقط {INVOICE_TTL_MINUTES} دقیقه امکان پرداخت وجود دارد، بعد از آن منقضی و درصورت پرداخت نیز وجه به حساب شما باز خواهد گشت.\n"
                 "🔹 درهنگام پرداخت باید صاحب حساب با شماره موبایل تایید شده در ربات همخوانی داشته باشد، در غیراینصورت تراکن شما با خطا مواجه خواهد شد.\n"
                 "🔹 به طور کلی در ترون استار ۲ روش برای پرداخت کارمزد انتقال شبکه ترون وجود دارد:\n"
                 "۱- کارمزد انتقال شبکه به فاکتور شما اضافه می‌شود و شما مقدار ترون وارد شده را به طور کامل دریافت خواهید کرد.\n"
@@ -518,58 +719,60 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "🔹 لطفا به‌شدت در وارد کردن آدرس ولت، مقدار ترون و روش کسر کارمزد دقت کنید. درصورت نهایی شدن تراکنش به هیچ‌وجه امکان بازگشت میسر نخواهد بود.\n"
                 "🔹 کلیه تراکنش‌ها به طور کامل در دیتابیس ذخیره می‌شوند، لذا درصورت بروز خطا در هر یک از مراحل تراکنش میتوانید با پشتیبانی در ارتباط باشید.\n\n"
                 "🔻 کلیک روی دکمه زیر و ثبت سفارش به منزله تایید قوانین ذکر شده می‌باشد.",
-                reply_markup=markup
+                markup
             )
-            await query.message.delete()
             
     elif query.data == "accept_rules":
-        user_data[query.message.chat.id] = {"status": "buying"}
         markup = InlineKeyboardMarkup([
             [InlineKeyboardButton("❌ لغو", callback_data="cancel")]
             ])
-        prompt_message = await query.message.reply_text(
-            "لطفاً مقدار ترون درخواستی خود را وارد کنید. (حداقل 1 و حداکثر 1350)",
-            reply_markup=markup
-            )
-        context.user_data[query.message.chat.id] = {
-            'trx_prompt_message_id': prompt_message.message_id
-            }
-        await query.message.delete()
+        prompt_message_id = await edit_or_send(
+            context.bot, chat_id, query.message, "لطفاً مقدار ترون درخواستی خود را وارد کنید. (حداقل 1 و حداکثر 1350)", markup
+        )
+        # هر خرید یک کلید یکتا دارد که تا صدور فاکتور همراه جلسه می‌ماند
+        await sessions.reset(chat_id, "buying", prompt_message_id=prompt_message_id, purchase_key=secrets.token_hex(8))
 
     elif query.data == "cancel":
-        await query.message.delete()
-        user_data[query.message.chat.id] = {"status": "idle"}
-        await query.message.reply_text("✅ عملیات لغو شد. به منوی اصلی بازگشتید.")
-        await start_handler(update, context)
+        await sessions.reset(chat_id)
+        await start_handler(update, context, "✅ عملیات لغو شد. به منوی اصلی بازگشتید.")
+
+    elif query.data == "alerts":
+        await price_alerts_handler(update, context)
+
+    elif query.data in ("alert_above", "alert_below"):
+        await sessions.reset(chat_id, "alert_threshold", alert_direction=ABOVE if query.data == "alert_above" else BELOW)
+        markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ لغو", callback_data="cancel")]
+        ])
+        await edit_or_send(context.bot, chat_id, query.message, "لطفاً قیمت هدف ترون را به تومان وارد کنید:", markup)
+
+    elif query.data.startswith("alert_del_"):
+        alert_id = int(query.data[len("alert_del_"):])
+        if await price_alerts.cancel(query.from_user.id, alert_id):
+            await price_alerts_handler(update, context, "✅ هشدار قیمت حذف شد.")
+        else:
+            await price_alerts_handler(update, context)
 
     elif query.data == "request_acceptance":
-        await query.message.reply_text("برای درخواست پذیرندگی، اطلاعات خود را ارسال کنید.")
-        await query.message.delete()
+        await edit_or_send(context.bot, chat_id, query.message, "برای درخواست پذیرندگی، اطلاعات خود را ارسال کنید.")
 
     elif query.data == "contact_us":
-        await query.message.reply_text("برای ارتباط با ما یا رهگیری تراکنش، با پشتیبانی تماس بگیرید.")
-        await query.message.delete()
+        await edit_or_send(context.bot, chat_id, query.message, "برای ارتباط با ما یا رهگیری تراکنش، با پشتیبانی تماس بگیرید.")
 
     elif query.data == 'check_membership':
         user_id = query.from_user.id
-        if await check_membership(context.bot, user_id):
-            await query.message.delete()
-            await query.message.reply_text("عضویت شما تایید شد. اکنون می‌توانید از امکانات ربات استفاده کنید.")
-            user_data[query.message.chat.id] = {"status": "idle"}
-            await start_handler(update, context)
+        if await check_membership(context.bot, user_id, force=True):
+            await sessions.reset(chat_id)
+            await start_handler(update, context, "عضویت شما تایید شد. اکنون می‌توانید از امکانات ربات استفاده کنید.")
         else:
             await query.message.reply_text("لطفاً در تمام کانال‌های اسپانسر عضو شوید و دوباره تلاش کنید.")
 
     elif query.data == "user_info":
         user_id = query.from_user.id
-        conn = sqlite3.connect(USERS_DB)
-        cursor = conn.cursor()
-        cursor.execute("SELECT role, card_number FROM users WHERE user_id = ?", (user_id,))
-        user_info = cursor.fetchone()
-        conn.close()
+        user_info = await user_cache.get(user_id)
 
         if user_info:
-            role, card_number = user_info
+            role, card_number = user_info.role, user_info.card_number
             role_text = "عادی" if role == 1 else "پذیرنده" if role == 2 else "مدیر"
             response_text = (
                 f"✅ اطلاعات کاربری شما در ترون استار:\n\n"
@@ -582,13 +785,12 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 [InlineKeyboardButton("لیست تراکنش‌ها 🧾", callback_data="list_transactions")]
                 ])
             
-            await query.message.reply_text(response_text, reply_markup=markup)
+            await edit_or_send(context.bot, chat_id, query.message, response_text, markup)
         else:
             await query.message.reply_text("❌ اطلاعات کاربری پیدا نشد.")
 
     elif query.data == "list_transactions":
         await list_transactions_handler(update, context)
-        await query.message.delete()
         
     elif query.data == "edit_card":
         await edit_card_handler(update, context)
@@ -596,111 +798,171 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data.startswith("view_"):
         await view_transaction_handler(update, context)
 
-    elif query.data == "prev_page":
-        user_id = update.effective_chat.id
-        context.user_data[f'page_{user_id}'] = max(0, context.user_data.get(f'page_{user_id}', 0) - 1)
-        await list_transactions_handler(update, context)
-        await query.message.delete()
-
-    elif query.data == "next_page":
-        user_id = update.effective_chat.id
-        context.user_data[f'page_{user_id}'] = context.user_data.get(f'page_{user_id}', 0) + 1
-        await list_transactions_handler(update, context)
-        await query.message.delete()
+    elif query.data.startswith("tx_"):
+        direction, cursor = parse_transactions_page_callback(query.data)
+        await list_transactions_handler(update, context, cursor, direction)
 
     elif query.data == "fee_toman":
-        trx_amount = user_data[query.message.chat.id]["trx_amount"]
-        wallet_address = user_data[query.message.chat.id]["wallet"]
+        if session.wallet is None:
+            # جلسه منقضی شده است
+            await query.message.reply_text("❌ اطلاعات خرید پیدا نشد. لطفاً دوباره از منوی اصلی اقدام کنید.")
+            return
+        if session.invoice_id is not None:
+            # دکمه روش کارمزد دوباره فشرده شده است
+            await reply_existing_invoice(context.bot, chat_id, session.invoice_id)
+            return
+        trx_amount = session.trx_amount
+        wallet_address = session.wallet
         fee_method = query.data
 
-        invoice_number = generate_invoice_number()  # تولید شماره فاکتور
-        fee_toman = int((trx_amount * 1.05 + 1.5) * get_trx_price())  # محاسبه مبلغ قابل پرداخت
+        # وقتی درگاه قطع است کاربر بدون انتظار برای درخواست بی‌نتیجه مطلع می‌شود
+        if not gateway.available:
+            await query.message.reply_text(GATEWAY_UNAVAILABLE_TEXT)
+            return
+
+        # قفل کردن قیمت برای کل فرآیند خرید
+        quote = await price_service.issue_quote()
+        if quote is None:
+            await query.message.reply_text("خطا در دریافت قیمت از API. لطفاً دوباره تلاش کنید.")
+            return
+        fee_toman = calculate_invoice_amount(trx_amount, fee_method, quote.price)  # محاسبه مبلغ قابل پرداخت
 
         # ایجاد فاکتور
-        payment_url, invoice_number = await create_invoice(query.message.chat_id, trx_amount, fee_method, wallet_address)
+        payment_url, invoice_number, created = await create_invoice(
+            query.message.chat_id, trx_amount, fee_method, wallet_address, quote, session.purchase_key
+        )
+        if invoice_number is None:
+            # جلسه خرید می‌ماند تا کاربر با همان دکمه‌ها قیمت جدید بگیرد
+            await query.message.reply_text(QUOTE_EXPIRED_TEXT)
+            return
+        if payment_url and not created:
+            await sessions.update(chat_id, status="waiting_for_payment", invoice_id=invoice_number)
+            await reply_existing_invoice(context.bot, chat_id, invoice_number)
+            return
     
         if payment_url:
-            user_data[query.message.chat_id] = {"status": "waiting_for_payment", "invoice": invoice_number}
+            await sessions.update(chat_id, status="waiting_for_payment", invoice_id=invoice_number)
             markup = InlineKeyboardMarkup([
                 [InlineKeyboardButton("💳 پرداخت فاکتور", url=payment_url)],
                 [InlineKeyboardButton("❌ لغو", callback_data="cancel_invoice")]
                 ])
             
-            message = await query.message.reply_text(
+            # پیام انتخاب روش کارمزد به فاکتور تبدیل می‌شود
+            message_id = await edit_or_send(
+                context.bot,
+                chat_id,
+                query.message,
                 f"✅ تراکنش شما با شماره {invoice_number} اطلاعات زیر در انتظار پرداخت فاکتور می‌باشد:\n\n"
                 f"🔹 مقدار ترون: {trx_amount}\n"
                 f"🔹 آدرس ولت: {wallet_address}\n"
                 f"🔹 روش پرداخت کارمزد: فاکتور تومانی\n\n"
                 f"💳 مبلغ قابل پرداخت: {format_price(fee_toman)} تومان\n\n"
-                f"🔻 فاکتور تا ۱۵ دقیقه آینده منقضی خواهد شد، لطفاً سریع‌تر پرداخت خود را نهایی کنید.\n\n"
+                f"🔻 فاکتور تا {INVOICE_TTL_MINUTES} دقیقه آینده منقضی خواهد شد، لطفاً سریع‌تر پرداخت خود را نهایی کنید.\n\n"
                 f"⚠️ با دکمه زیر فاکتور خود را پرداخت کنید. پرداخت فقط با آی‌پی ایران امکان‌پذیر است. لطفاً فیلترشکن خود را خاموش کنید و از کارتی که به نام خودتان است استفاده کنید.",
-                reply_markup=markup
+                markup
                 )
-            await query.message.delete()
-            update_message_chat_id(invoice_number, message.message_id)
+            await update_message_chat_id(invoice_number, message_id)
 
         else:
-            user_data[query.message.chat_id] = {"status": "idle"}
-            await query.message.delete()
-            await query.message.reply_text(
+            await sessions.reset(chat_id)
+            # بازگشت به منوی اصلی
+            await start_handler(
+                update,
+                context,
                 f"❌ کاربر گرامی، فاکتور شما با شماره {invoice_number} به دلیل وجود خطا در درخواست به پذیرنده صادر نشد. لطفاً مجدداً تلاش کنید."
-                )
-            await start_handler(update, context)  # بازگشت به منوی اصلی
+            )
 
 
     elif query.data == "fee_trx":
-        trx_amount = user_data[query.message.chat.id]["trx_amount"]
-        wallet_address = user_data[query.message.chat.id]["wallet"]
+        if session.wallet is None:
+            # جلسه منقضی شده است
+            await query.message.reply_text("❌ اطلاعات خرید پیدا نشد. لطفاً دوباره از منوی اصلی اقدام کنید.")
+            return
+        if session.invoice_id is not None:
+            # دکمه روش کارمزد دوباره فشرده شده است
+            await reply_existing_invoice(context.bot, chat_id, session.invoice_id)
+            return
+        trx_amount = session.trx_amount
+        wallet_address = session.wallet
         fee_method = query.data
 
-        invoice_number = generate_invoice_number()  # تولید شماره فاکتور
-        fee_toman = int(trx_amount * 1.05 * get_trx_price())  # محاسبه مبلغ به تومان
+        # وقتی درگاه قطع است کاربر بدون انتظار برای درخواست بی‌نتیجه مطلع می‌شود
+        if not gateway.available:
+            await query.message.reply_text(GATEWAY_UNAVAILABLE_TEXT)
+            return
+
+        # قفل کردن قیمت برای کل فرآیند خرید
+        quote = await price_service.issue_quote()
+        if quote is None:
+            await query.message.reply_text("خطا در دریافت قیمت از API. لطفاً دوباره تلاش کنید.")
+            return
+        fee_toman = calculate_invoice_amount(trx_amount, fee_method, quote.price)  # محاسبه مبلغ به تومان
         received_trx = trx_amount - 1.5  # مقدار ترونی که کاربر دریافت می‌کند
 
         # ایجاد فاکتور
-        payment_url, invoice_number = await create_invoice(query.message.chat_id, trx_amount, fee_method, wallet_address)
+        payment_url, invoice_number, created = await create_invoice(
+            query.message.chat_id, trx_amount, fee_method, wallet_address, quote, session.purchase_key
+        )
+        if invoice_number is None:
+            # جلسه خرید می‌ماند تا کاربر با همان دکمه‌ها قیمت جدید بگیرد
+            await query.message.reply_text(QUOTE_EXPIRED_TEXT)
+            return
+        if payment_url and not created:
+            await sessions.update(chat_id, status="waiting_for_payment", invoice_id=invoice_number)
+            await reply_existing_invoice(context.bot, chat_id, invoice_number)
+            return
 
         if payment_url:
             # موفقیت در ایجاد فاکتور
-            user_data[query.message.chat_id] = {"status": "waiting_for_payment", "invoice": invoice_number}
+            await sessions.update(chat_id, status="waiting_for_payment", invoice_id=invoice_number)
 
             markup = InlineKeyboardMarkup([
                 [InlineKeyboardButton("💳 پرداخت فاکتور", url=payment_url)],
                 [InlineKeyboardButton("❌ لغو", callback_data="cancel_invoice")]
             ])
 
-            message = await query.message.reply_text(
+            # پیام انتخاب روش کارمزد به فاکتور تبدیل می‌شود
+            message_id = await edit_or_send(
+                context.bot,
+                chat_id,
+                query.message,
                 f"✅ تراکنش شما با شماره {invoice_number} اطلاعات زیر در انتظار پرداخت فاکتور می‌باشد:\n\n"
                 f"🔹 مقدار ترون: {trx_amount}\n"
                 f"🔹 آدرس ولت: {wallet_address}\n"
                 f"🔹 روش پرداخت کارمزد: ترون\n\n"
                 f"💳 مبلغ قابل پرداخت: {format_price(fee_toman)} تومان\n\n"
                 f"🔴 در این روش، فی انتقال شبکه از ترون ارسال شده کسر خواهد شد. شما حدود {received_trx:.1f} ترون دریافت خواهید کرد.\n\n"
-                f"🔻 فاکتور تا ۱۵ دقیقه آینده منقضی خواهد شد، لطفاً سریع‌تر پرداخت خود را نهایی کنید.\n\n"
+                f"🔻 فاکتور تا {INVOICE_TTL_MINUTES} دقیقه آینده منقضی خواهد شد، لطفاً سریع‌تر پرداخت خود را نهایی کنید.\n\n"
                 f"⚠️ با دکمه زیر فاکتور خود را پرداخت کنید. پرداخت فقط با آی‌پی ایران امکان‌پذیر است. لطفاً فیلترشکن خود را خاموش کنید و از کارتی که به نام خودتان است استفاده کنید.",
-                reply_markup=markup
+                markup
             )
-            update_message_chat_id(invoice_number, message.message_id)
+            await update_message_chat_id(invoice_number, message_id)
         else:
-            user_data[query.message.chat_id] = {"status": "idle"}
-            await query.message.delete()
-            await query.message.reply_text(
+            await sessions.reset(chat_id)
+            # بازگشت به منوی اصلی
+            await start_handler(
+                update,
+                context,
                 f"❌ کاربر گرامی، فاکتور شما با شماره {invoice_number} به دلیل وجود خطا در درخواست به پذیرنده صادر نشد. لطفاً مجدداً تلاش کنید."
             )
-            await start_handler(update, context)  # بازگشت به منوی اصلی
 
 
     elif query.data == "cancel_invoice":
-        invoice_number = user_data.get(query.message.chat.id, {}).get("invoice", "نامشخص")
-        user_data[query.message.chat.id] = {"status": "idle"}
-        update_invoice_status(invoice_number, "canceled")
-        await query.message.delete()  # حذف پیام فاکتور
-        await query.message.reply_text(f"❌ کاربر گرامی، سفارش شما با شماره {invoice_number} لغو شد.")
-        await start_handler(update, context)  # بازگشت به منوی اصلی
+        invoice_number = session.invoice_id or "نامشخص"
+        await sessions.reset(chat_id)
+        if session.invoice_id is not None and not await cancel_pending_invoice(invoice_number):
+            # کالبک یا وریفای دوره‌ای زودتر وضعیت فاکتور را ثبت کرده است؛ پیام فاکتور با رویداد پرداخت به‌روز می‌شود
+            await query.message.reply_text(f"ℹ️ فاکتور شماره {invoice_number} قبلاً تعیین وضعیت شده است و لغو نشد.")
+            return
+        # پیام فاکتور با منوی اصلی جایگزین می‌شود و دیگر پیام این فاکتور نیست
+        await update_message_chat_id(invoice_number, None)
+        await start_handler(update, context, f"❌ کاربر گرامی، سفارش شما با شماره {invoice_number} لغو شد.")
 
 
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_status = context.user_data.get('status', 'idle')
+    chat_id = update.effective_chat.id
+    session = await sessions.get(chat_id)
+    user_status = session.status
 
     if user_status == 'edit_card':
         card_number = update.message.text.replace(" ", "")
@@ -710,18 +972,16 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         user_id = update.effective_user.id
         # به‌روزرسانی شماره کارت در دیتابیس
-        conn = sqlite3.connect(USERS_DB)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET card_number = ? WHERE user_id = ?", (card_number, user_id))
-        conn.commit()
-        conn.close()
+        await user_cache.update_card(user_id, card_number)
         
-        del context.user_data['status']  # حذف وضعیت ویرایش
-        await update.message.reply_text("✅ شماره کارت شما با موفقیت به‌روزرسانی شد.")
+        await sessions.reset(chat_id)  # حذف وضعیت ویرایش
+        await edit_or_send(context.bot, chat_id, session.prompt_message_id, "✅ شماره کارت شما با موفقیت به‌روزرسانی شد.")
         await show_main_menu(update, context)
 
     elif user_status == 'card':
         await handle_card_number(update, context)
+    elif user_status == 'alert_threshold':
+        await handle_alert_threshold(update, context)
     elif user_status == "buying":
         try:
             trx_amount = float(update.message.text)
@@ -729,27 +989,17 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ مقدار واردشده خارج از محدودیت است. لطفاً عددی بین 1 تا 1350 وارد کنید.")
                 return
 
-            context.user_data[update.effective_chat.id] = {
-                "status": "waiting_for_wallet",
-                "trx_amount": trx_amount
-            }
             markup = InlineKeyboardMarkup([
                 [InlineKeyboardButton("❌ لغو", callback_data="cancel")]
             ])
-            # ذخیره پیام درخواست آدرس ولت
-            prompt_message = await update.message.reply_text(
-                "لطفاً آدرس ولت ارز ترون خود را ارسال کنید.",
-                reply_markup=markup
+            # پیام درخواست مقدار ترون به درخواست آدرس ولت تبدیل می‌شود
+            prompt_message_id = await edit_or_send(
+                context.bot, chat_id, session.prompt_message_id, "لطفاً آدرس ولت ارز ترون خود را ارسال کنید.", markup
+            )
+            await sessions.reset(
+                chat_id, "waiting_for_wallet", trx_amount=trx_amount, prompt_message_id=prompt_message_id,
+                purchase_key=session.purchase_key
             )
-            context.user_data[update.effective_chat.id]['wallet_prompt_message_id'] = prompt_message.message_id
-
-            # حذف پیام مربوط به درخواست مقدار ترون
-            if 'trx_prompt_message_id' in context.user_data[update.effective_chat.id]:
-                trx_prompt_message_id = context.user_data[update.effective_chat.id]['trx_prompt_message_id']
-                try:
-                    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=trx_prompt_message_id)
-                except Exception as e:
-                    logger.error(f"Error deleting message: {e}")
 
             await update.message.delete()
 
@@ -762,57 +1012,96 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ آدرس ولت نامعتبر است. لطفاً دوباره تلاش کنید.")
             return
 
-        trx_amount = context.user_data[update.effective_chat.id]["trx_amount"]
-        context.user_data[update.effective_chat.id] = {
-            "status": "waiting_for_payment",
-            "trx_amount": trx_amount,
-            "wallet": wallet_address
-        }
+        await sessions.reset(
+            chat_id, "waiting_for_payment", trx_amount=session.trx_amount, wallet=wallet_address,
+            purchase_key=session.purchase_key
+        )
 
         markup = InlineKeyboardMarkup([
             [InlineKeyboardButton("فاکتور تومانی", callback_data="fee_toman")],
             [InlineKeyboardButton("ترون", callback_data="fee_trx")]
         ])
-        await update.message.delete()
-        await update.message.reply_text(
-            "لطفاً روش پرداخت کارمزد انتقال شبکه ترون را انتخاب کنید.",
-            reply_markup=markup
+        # پیام درخواست آدرس ولت به انتخاب روش کارمزد تبدیل می‌شود
+        await edit_or_send(
+            context.bot, chat_id, session.prompt_message_id,
+            "لطفاً روش پرداخت کارمزد انتقال شبکه ترون را انتخاب کنید.", markup
         )
+        await update.message.delete()
 
-        if 'wallet_prompt_message_id' in context.user_data[update.effective_chat.id]:
-            wallet_prompt_message_id = context.user_data[update.effective_chat.id]['wallet_prompt_message_id']
-            try:
-                await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=wallet_prompt_message_id)
-            except Exception as e:
-                logger.error(f"Error deleting message: {e}")
 
+async def save_price_history(context: ContextTypes.DEFAULT_TYPE):
+    """ذخیره دوره‌ای snapshot تاریخچه قیمت روی دیسک"""
+    try:
+        # snapshot روی حلقه رویداد گرفته می‌شود تا با اضافه شدن قیمت جدید همزمان نشود؛ فقط نوشتن فایل در thread است
+        await asyncio.to_thread(price_history.write, PRICE_HISTORY_FILE, price_history.dumps())
+    except OSError as e:
+        logger.error(f"خطا در ذخیره تاریخچه قیمت: {e}")
 
 # ====== تنظیمات اصلی ======
+async def on_startup(application: Application):
+    """باز کردن اتصال‌های دیتابیس پیش از دریافت آپدیت‌ها"""
+    await invoices_db.connect()
+    await users_db.connect()
+    await migrate(invoices_db, INVOICES_MIGRATIONS)  # ساخت یا به‌روزرسانی جدول فاکتورها
+    await migrate(users_db, USERS_MIGRATIONS)  # ساخت یا به‌روزرسانی جدول کاربران
+    await sessions.start()
+    await payment_events.start(partial(handle_payment_event, application.bot))
+    await expiry_scheduler.start(partial(notify_expired_invoices, application.bot))
+    price_history.load(PRICE_HISTORY_FILE)
+    await price_alerts.start(application.bot)
+    await price_service.start()
+
+async def on_shutdown(application: Application):
+    """بستن اتصال‌های دیتابیس"""
+    await expiry_scheduler.stop()
+    await price_service.stop()
+    await price_alerts.stop()
+    await save_price_history(None)
+    await payment_events.stop()
+    await gateway.close()
+    await sessions.stop()
+    await invoices_db.close()
+    await users_db.close()
+
 def main():
-    init_db()  # اطمینان از ایجاد دیتابیس فاکتورها
-    init_user_db()  # ایجاد دیتابیس کاربران
-    
     # تغییر در ایجاد application
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        # آپدیت‌های چت‌های مختلف همزمان و آپدیت‌های هر چت به ترتیب پردازش می‌شوند
+        .concurrent_updates(ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        # ارسال‌ها با محدودیت نرخ تلگرام و اولویت پاسخ به کاربر بر اعلان‌های پس‌زمینه
+        .rate_limiter(PriorityRateLimiter(SEND_RATE_PER_SECOND, CHAT_SEND_RATE_PER_SECOND))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # اضافه کردن هندلرها
     application.add_handler(CommandHandler("start", start_handler))
     application.add_handler(CallbackQueryHandler(callback_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
     application.add_handler(MessageHandler(filters.CONTACT, handle_contact))
-    application.add_handler(CallbackQueryHandler(navigation_handler, pattern="^(next_page|prev_page)$"))
     application.add_handler(CallbackQueryHandler(view_transaction_handler, pattern="^view_"))
+    application.add_handler(ChatMemberHandler(membership.on_chat_member, ChatMemberHandler.CHAT_MEMBER))
 
-    try:
-        # اضافه کردن job queue با exception handling
-        if application.job_queue:
-            application.job_queue.run_repeating(monitor_invoices, interval=60, first=0)
-    except Exception as e:
-        logger.error(f"Error setting up job queue: {e}")
-        print("Warning: Job queue could not be initialized. Invoice monitoring may not work properly.")
+    if application.job_queue:
+        application.job_queue.run_repeating(save_price_history, interval=300, first=300)
 
     print("ربات فعال شد!")
-    application.run_polling()
+    if WEBHOOK_URL:
+        # آپدیت‌های تلگرام و کالبک درگاه با یک سرور و دیتابیس و کلاینت درگاه مشترک
+        asyncio.run(run_webhook(
+            application,
+            WEBHOOK_URL,
+            WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            routes=callback.create_routes(invoices_db, gateway, EVENTS_SOCKET),
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+        ))
+    else:
+        # رویدادهای chat_member به صورت پیش‌فرض ارسال نمی‌شوند
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
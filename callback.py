@@ -1,107 +1,131 @@
-import sqlite3
-from flask import Flask, request, jsonify, render_template
-import requests
-
-app = Flask(__name__)
-
-# تنظیمات اولیه
-verify_url = "https://panel.aqayepardakht.ir/api/v2/verify"
-pin_code = "sandbox"  # پین کد تست
-
-
-def get_amount_from_db(invoice_id):
-    
-    conn = sqlite3.connect("invoices.db")
-    cursor = conn.cursor()
-
-    query = "SELECT amount, transid FROM transactions WHERE invoice_id = ?"
-    cursor.execute(query, (invoice_id,))
-    result = cursor.fetchone()
-    conn.close()
-
-    return result if result else None
-
-@app.route('/callback', methods=['POST'])
-def callback():
-    
-    print("Headers:", request.headers)
-    print("Body:", request.data)
-
-    # پردازش داده‌ها
-    if request.is_json:
-        data = request.json
-    elif request.form:
-        data = request.form.to_dict()
-    else:
-        return jsonify({"error": "Unsupported Media Type"}), 415
-
-    print("Received Data:", data)
-
-    # بررسی پارامترها
-    invoice_id = data.get('invoice_id')
-    transid = data.get('transid')
-    status = data.get('status')  # دریافت status از کالبک
-
-    if not invoice_id or not transid or status is None:
-        return jsonify({"error": "پارامترهای لازم ارسال نشده است"}), 400
-
-    # اگر status برابر با ۱ نباشه
-    if status != '1':
-        if status == '2':  # اگر status برابر با ۲ باشد
-            message = "تراکنش قبلاً تایید شده و پرداخت شده است."
-        else:
-            message = "تراکنش انجام نشد."
-        return render_template('status.html', message=message)
-
-    # استخراج مبلغ از دیتابیس
-    result = get_amount_from_db(invoice_id)
-    if not result:
-        return jsonify({"error": "Invoice ID not found in database"}), 404
-
-    amount = result[0]
-    print(f"Retrieved amount from DB: {amount}")
-
-    # داده‌های مورد نیاز برای وریفای
-    verify_data = {
-        "pin": pin_code,
-        "amount": amount,
-        "transid": transid
-    }
-    print("Sending data to verify API:", verify_data)
-
-    # ارسال درخواست وریفای
-    try:
-        response = requests.post(verify_url, json=verify_data)
-        print("Response Status Code:", response.status_code)
-
-        if response.status_code == 200:
-            result = response.json()
-            print("Response JSON:", result)
-
-            
-            try:
-                code = int(result.get("code", -99))  # مقدار پیش‌فرض برای وضعیت نامشخص
-            except ValueError:
-                code = -99  
-
-            # وضعیت‌ها
-            if code == 1:
-                message = "پرداخت شما با موفقیت انجام شد."
-            elif code == 0:
-                message = "پرداخت انجام نشد، لطفاً دوباره تلاش کنید."
-            elif code == 2:
-                message = "این تراکنش قبلاً وریفای و تایید شده است."
-            else:
-                message = f"وضعیت نامشخص دریافت شد: {code}"
-
-        else:
-            message = f"خطای غیرمنتظره از سمت سرور: {response.status_code}"
-
-    except Exception as e:
-        message = f"خطا در ارتباط با API: {str(e)}"
-
-    # نمایش نتیجه در هتمل
-    return render_template('status.html', message=message)
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from html import escape
+from urllib.parse import parse_qsl
+
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, JSONResponse
+from starlette.routing import Route
+
+from db import Database
+from gateway import AqayepardakhtClient
+from payment_events import notify
+from payments import VERIFY_MESSAGES, PaymentError, PaymentVerifier, get_invoice_payment
+
+logger = logging.getLogger(__name__)
+
+# قالب صفحه نتیجه پرداخت
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'status.html'), 'r', encoding='utf-8') as template_file:
+    STATUS_TEMPLATE = template_file.read()
+
+
+def render_status(message):
+    return HTMLResponse(STATUS_TEMPLATE.replace("{{ message }}", escape(message)))
+
+
+async def read_callback_data(request):
+    """
+    خواندن پارامترهای کالبک درگاه از بدنه JSON یا فرم
+    برای نوع محتوای پشتیبانی‌نشده None برمی‌گردد و برای بدنه نامعتبر ValueError می‌دهد.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        data = await request.json()
+        if not isinstance(data, dict):
+            raise ValueError("بدنه JSON کالبک باید یک شیء باشد.")
+        return data
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return dict(parse_qsl((await request.body()).decode()))
+    return None
+
+
+def create_routes(invoices_db, gateway, events_socket=None):
+    """
+    مسیر /callback با دیتابیس و کلاینت درگاه مشترک
+    هر کالبک یک coroutine است؛ خواندن مبلغ از invoices و وریفای از طریق استخر اتصال
+    درگاه انجام می‌شود، پس کالبک‌های همزمان زیاد بدون یک thread برای هر درخواست پاسخ می‌گیرند.
+    پس از ثبت نتیجه، ربات از طریق events_socket بیدار می‌شود تا کاربر را مطلع کند.
+    کالبک‌های تکراری درگاه از نتیجه ثبت‌شده پاسخ می‌گیرند و دوباره وریفای نمی‌شوند.
+    """
+    verifier = PaymentVerifier(invoices_db, gateway)
+
+    async def callback(request):
+        try:
+            data = await read_callback_data(request)
+        except ValueError as e:
+            logger.warning(f"بدنه کالبک نامعتبر است: {e}")
+            return JSONResponse({"error": "بدنه درخواست نامعتبر است"}, status_code=400)
+        if data is None:
+            return JSONResponse({"error": "Unsupported Media Type"}, status_code=415)
+
+        # بررسی پارامترها
+        invoice_id = data.get('invoice_id')
+        transid = data.get('transid')
+        status = data.get('status')  # دریافت status از کالبک
+
+        if not invoice_id or not transid or status is None:
+            return JSONResponse({"error": "پارامترهای لازم ارسال نشده است"}, status_code=400)
+
+        logger.info(f"کالبک درگاه برای فاکتور {invoice_id} با وضعیت {status} دریافت شد.")
+
+        # اگر status برابر با ۱ نباشه
+        if str(status) != '1':
+            invoice = await get_invoice_payment(invoices_db, invoice_id)
+            if invoice is None or str(invoice[1]) != str(transid):
+                logger.warning(f"کالبک نامعتبر برای فاکتور {invoice_id}")
+                return JSONResponse({"error": "Invoice ID not found in database"}, status_code=404)
+            if str(status) == '2':  # اگر status برابر با ۲ باشد
+                return render_status("تراکنش قبلاً تایید شده و پرداخت شده است.")
+            # وضعیت کالبک ناموفق بدون وریفای قابل اعتماد نیست؛ فاکتور معلق می‌ماند تا کاربر
+            # دوباره پرداخت کند یا زمان‌بند انقضا آن را لغو کند
+            return render_status("تراکنش انجام نشد.")
+
+        try:
+            code, status = await verifier.verify(invoice_id, transid)
+        except PaymentError as e:
+            logger.warning(f"کالبک نامعتبر: {e}")
+            return JSONResponse({"error": "Invoice ID not found in database"}, status_code=404)
+        except Exception as e:
+            # فاکتور معلق می‌ماند تا با کالبک یا وریفای بعدی تعیین وضعیت شود
+            logger.error(f"خطا در وریفای فاکتور {invoice_id}: {e}")
+            return render_status("خطا در ارتباط با درگاه پرداخت. نتیجه پرداخت به‌زودی در ربات اعلام می‌شود.")
+
+        if status is not None:
+            notify(events_socket)
+
+        # نمایش نتیجه در هتمل
+        return render_status(VERIFY_MESSAGES.get(code, f"وضعیت نامشخص دریافت شد: {code}"))
+
+    return [Route("/callback", callback, methods=["POST"])]
+
+
+def create_app():
+    """سرور مستقل کالبک (وقتی ربات در حالت polling اجرا می‌شود)"""
+    with open('config.json', 'r', encoding='utf-8') as config_file:
+        config = json.load(config_file)
+
+    invoices_db = Database(config['invoices'])
+    gateway = AqayepardakhtClient(
+        config.get('gateway_pin', 'sandbox'), config.get('gateway_callback_url', 'http://127.0.0.1:5000/callback')
+    )
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await invoices_db.connect()
+        try:
+            yield
+        finally:
+            await gateway.close()
+            await invoices_db.close()
+
+    routes = create_routes(invoices_db, gateway, config.get('events_socket', 'payment_events.sock'))
+    return Starlette(routes=routes, lifespan=lifespan)
+
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    import uvicorn
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    uvicorn.run(create_app(), host="127.0.0.1", port=5000)
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class Database:
+    """
+    دسترسی async به یک فایل SQLite با اتصال‌های ماندگار
+    یک اتصال برای نوشتن و یک استخر از اتصال‌ها برای خواندن نگه داشته می‌شود تا
+    هیچ کوئری‌ای حلقه رویداد را مسدود نکند و هزینه باز و بسته کردن اتصال حذف شود.
+    چون اتصال‌ها بسته نمی‌شوند، کش statement خود sqlite3 کوئری‌های ثابت را
+    فقط یک بار prepare می‌کند.
+
+    همه نوشتن‌ها در یک صف قرار می‌گیرند و یک تسک نویسنده آن‌ها را هر چند میلی‌ثانیه
+    در یک تراکنش واحد commit می‌کند (group commit). هر فراخوان یک future می‌گیرد که
+    پس از commit شدن تراکنش کامل می‌شود. دیتابیس در حالت WAL باز می‌شود تا
+    خواننده‌ها و پروسه سرور کالبک پشت نویسنده قفل نشوند.
+    """
+
+    def __init__(self, path, read_pool_size=4, cached_statements=128, batch_window=0.002, max_batch=256):
+        self.path = path
+        self.read_pool_size = read_pool_size
+        self.cached_statements = cached_statements
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._writer = None
+        self._readers = None
+        self._queue = None
+        self._writer_task = None
+        self._write_lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
+
+    async def _open(self, isolation_level=""):
+        conn = await aiosqlite.connect(
+            self.path, cached_statements=self.cached_statements, isolation_level=isolation_level
+        )
+        await self._pragma(conn, "PRAGMA busy_timeout = 5000")
+        return conn
+
+    @staticmethod
+    async def _pragma(conn, sql):
+        # خواندن کامل نتیجه لازم است؛ در غیر این صورت statement باز می‌ماند و فایل قفل می‌شود
+        async with conn.execute(sql) as cursor:
+            return await cursor.fetchall()
+
+    async def connect(self):
+        """باز کردن اتصال نویسنده و استخر خواننده‌ها (فقط یک بار)"""
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            # اتصال نویسنده در حالت autocommit است و تراکنش‌ها را خود تسک نویسنده باز می‌کند
+            self._writer = await self._open(isolation_level=None)
+            await self._pragma(self._writer, "PRAGMA journal_mode = WAL")
+            # هر commit پیش از کامل شدن future روی دیسک fsync می‌شود؛ هزینه آن با group commit
+            # بین همه نوشتن‌های یک دسته تقسیم می‌شود
+            await self._pragma(self._writer, "PRAGMA synchronous = FULL")
+            readers = asyncio.Queue()
+            for _ in range(self.read_pool_size):
+                readers.put_nowait(await self._open())
+            self._readers = readers
+            self._queue = asyncio.Queue()
+            self._writer_task = asyncio.create_task(self._write_loop())
+            logger.info(f"اتصال به دیتابیس {self.path} برقرار شد.")
+
+    async def close(self):
+        """بستن همه اتصال‌ها"""
+        async with self._connect_lock:
+            if self._writer is None:
+                return
+            # نوشتن‌های باقی‌مانده در صف پیش از بستن اتصال commit می‌شوند
+            self._queue.put_nowait(None)
+            await self._writer_task
+            while not self._readers.empty():
+                await self._readers.get_nowait().close()
+            await self._writer.close()
+            self._writer = None
+            self._readers = None
+            self._queue = None
+            self._writer_task = None
+
+    @asynccontextmanager
+    async def _reader(self):
+        if self._writer is None:
+            await self.connect()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def fetchone(self, sql, params=()):
+        """اجرای کوئری خواندنی و برگرداندن اولین سطر"""
+        async with self._reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        """اجرای کوئری خواندنی و برگرداندن همه سطرها"""
+        async with self._reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    def submit(self, sql, params=(), many=False, returning=False):
+        """
+        قرار دادن یک دستور نوشتنی در صف نویسنده
+        یک future برمی‌گرداند که پس از commit شدن (و fsync)، تعداد سطرهای تغییرکرده را می‌دهد
+        (یا برای returning=True سطرهای برگشتی از بند RETURNING را).
+        """
+        if self._writer is None:
+            raise RuntimeError(f"دیتابیس {self.path} هنوز متصل نشده است.")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((sql, params, many, returning, future))
+        return future
+
+    async def execute(self, sql, params=()):
+        """اجرای یک دستور نوشتنی و انتظار تا commit شدن آن"""
+        if self._writer is None:
+            await self.connect()
+        return await self.submit(sql, params)
+
+    async def executemany(self, sql, seq_of_params):
+        """اجرای یک دستور برای چند ردیف پارامتر به صورت اتمیک"""
+        if self._writer is None:
+            await self.connect()
+        return await self.submit(sql, list(seq_of_params), many=True)
+
+    async def transaction(self, statements):
+        """
+        اجرای چند دستور چندردیفی به صورت اتمیک (همه یا هیچ)
+        statements لیستی از (sql, لیست پارامترها) است؛ خروجی تعداد سطرهای تغییرکرده هر دستور است.
+        """
+        if self._writer is None:
+            await self.connect()
+        return await self.submit(None, [(sql, list(seq_of_params)) for sql, seq_of_params in statements], many=True)
+
+    async def execute_returning(self, sql, params=()):
+        """اجرای یک دستور نوشتنی دارای RETURNING و برگرداندن سطرهای آن پس از commit"""
+        if self._writer is None:
+            await self.connect()
+        return await self.submit(sql, params, returning=True)
+
+    async def executescript(self, script):
+        """اجرای چند دستور (برای ساخت جدول‌ها)"""
+        if self._writer is None:
+            await self.connect()
+        async with self._write_lock:
+            try:
+                await self._writer.executescript(script)
+            except Exception:
+                if self._writer.in_transaction:
+                    await self._writer.execute("ROLLBACK")
+                raise
+
+    async def _next_batch(self):
+        """گرفتن اولین نوشتن و جمع کردن نوشتن‌های رسیده در پنجره batch_window"""
+        batch = [await self._queue.get()]
+        if batch[0] is None:
+            return batch
+        await asyncio.sleep(self.batch_window)
+        while len(batch) < self.max_batch and not self._queue.empty():
+            item = self._queue.get_nowait()
+            batch.append(item)
+            if item is None:
+                break
+        return batch
+
+    async def _write_loop(self):
+        """تسک نویسنده: هر دسته از نوشتن‌ها در یک تراکنش commit می‌شود"""
+        while True:
+            batch = await self._next_batch()
+            stop = batch[-1] is None
+            items = [item for item in batch if item is not None]
+            if items:
+                async with self._write_lock:
+                    await self._commit_batch(items)
+            if stop:
+                return
+
+    async def _commit_batch(self, items):
+        results = []
+        try:
+            await self._writer.execute("BEGIN IMMEDIATE")
+            for sql, params, many, returning, future in items:
+                # هر نوشتن savepoint خودش را دارد تا خطای یکی کل دسته را باطل نکند
+                await self._writer.execute("SAVEPOINT write_item")
+                try:
+                    if sql is None:
+                        # چند دستور در همین savepoint (از transaction)
+                        result = []
+                        for statement, seq_of_params in params:
+                            cursor = await self._writer.executemany(statement, seq_of_params)
+                            result.append(cursor.rowcount)
+                            await cursor.close()
+                        results.append((future, result, None))
+                        await self._writer.execute("RELEASE write_item")
+                        continue
+                    if many:
+                        cursor = await self._writer.executemany(sql, params)
+                    else:
+                        cursor = await self._writer.execute(sql, params)
+                    result = await cursor.fetchall() if returning else cursor.rowcount
+                    await cursor.close()
+                    results.append((future, result, None))
+                    await self._writer.execute("RELEASE write_item")
+                except Exception as e:
+                    await self._writer.execute("ROLLBACK TO write_item")
+                    await self._writer.execute("RELEASE write_item")
+                    results.append((future, None, e))
+            await self._writer.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"خطا در commit دسته نوشتن روی {self.path}: {e}")
+            if self._writer.in_transaction:
+                await self._writer.execute("ROLLBACK")
+            for *_, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -0,0 +1,112 @@
+import asyncio
+import heapq
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """
+    زمان‌بند انقضای فاکتورهای معلق
+    فاکتورهای معلق در یک min-heap بر اساس مهلت پرداخت نگه داشته می‌شوند و تسک زمان‌بند
+    دقیقاً تا رسیدن نزدیک‌ترین مهلت می‌خوابد. همه فاکتورهای منقضی‌شده با یک UPDATE لغو
+    می‌شوند؛ شرط status = 'pending' باعث می‌شود فاکتورهای پرداخت‌شده یا لغوشده دست نخورند.
+    """
+
+    def __init__(self, db, ttl_seconds=15 * 60, max_batch=500):
+        self.db = db
+        self.on_expired = None
+        self.ttl_seconds = ttl_seconds
+        self.max_batch = max_batch
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._notify_tasks = set()
+
+    async def start(self, on_expired):
+        """
+        بازسازی heap از فاکتورهای معلق دیتابیس و شروع تسک زمان‌بند
+        on_expired با لیست (invoice_id, user_id, message_chat_id) فاکتورهای لغوشده صدا زده می‌شود.
+        """
+        self.on_expired = on_expired
+        rows = await self.db.fetchall("""
+            SELECT invoice_id, CAST(strftime('%s', created_at) AS INTEGER) FROM invoices
+            WHERE status = 'pending'
+        """)
+        self._heap = [(created_at + self.ttl_seconds, invoice_id) for invoice_id, created_at in rows]
+        heapq.heapify(self._heap)
+        logger.info(f"{len(self._heap)} فاکتور معلق در زمان‌بند انقضا بارگذاری شد.")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def schedule(self, invoice_id, deadline=None):
+        """افزودن فاکتور تازه صادرشده به زمان‌بند"""
+        if deadline is None:
+            deadline = time.time() + self.ttl_seconds
+        heapq.heappush(self._heap, (deadline, str(invoice_id)))
+        if self._heap[0][0] == deadline:
+            # مهلت جدید زودتر از مهلتی است که تسک برایش خوابیده
+            self._wakeup.set()
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.max_batch:
+            _, invoice_id = heapq.heappop(self._heap)
+            due.append(invoice_id)
+        return due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = self._pop_due(time.time())
+            try:
+                expired = await self.expire(due)
+            except Exception as e:
+                logger.error(f"خطا در لغو فاکتورهای منقضی‌شده: {e}")
+                for invoice_id in due:
+                    # تلاش دوباره چند ثانیه بعد
+                    heapq.heappush(self._heap, (time.time() + 5, invoice_id))
+                continue
+
+            if expired:
+                task = asyncio.create_task(self._notify(expired))
+                self._notify_tasks.add(task)
+                task.add_done_callback(self._notify_tasks.discard)
+
+    async def expire(self, invoice_ids):
+        """لغو دسته‌ای فاکتورها با یک UPDATE و برگرداندن (invoice_id, user_id, message_chat_id) لغوشده‌ها"""
+        if not invoice_ids:
+            return []
+        placeholders = ", ".join("?" * len(invoice_ids))
+        return await self.db.execute_returning(f"""
+            UPDATE invoices SET status = 'canceled'
+            WHERE status = 'pending' AND invoice_id IN ({placeholders})
+            RETURNING invoice_id, user_id, message_chat_id
+        """, invoice_ids)
+
+    async def _notify(self, expired):
+        try:
+            await self.on_expired(expired)
+        except Exception as e:
+            logger.error(f"خطا در اطلاع‌رسانی لغو فاکتورها: {e}")
@@ -0,0 +1,107 @@
+import logging
+
+import httpx
+
+from resilience import ResilientEndpoint
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_BASE_URL = "https://panel.aqayepardakht.ir"
+
+
+class GatewayError(Exception):
+    """پاسخ ناموفق یا نامعتبر از درگاه پرداخت"""
+
+
+class AqayepardakhtClient:
+    """
+    کلاینت async درگاه آقای پرداخت
+    یک httpx.AsyncClient با استخر اتصال keep-alive بین صدور و وریفای فاکتورها مشترک است و
+    هر درخواست timeout جداگانه برای اتصال و خواندن دارد، پس کندی درگاه برای یک کاربر
+    حلقه رویداد را برای بقیه مسدود نمی‌کند.
+    """
+
+    def __init__(self, pin, callback_url, connect_timeout=5, read_timeout=15, max_connections=20, max_keepalive=10):
+        self.pin = pin
+        self.callback_url = callback_url
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self._client = None
+        # صدور تراکنش idempotent نیست؛ فقط وقتی درخواست اصلاً به درگاه نرسیده دوباره تلاش می‌شود
+        self.create_endpoint = ResilientEndpoint(
+            "gateway-create", retry_on=(httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+        )
+        # وریفای تکراری همان نتیجه را برمی‌گرداند، پس تلاش دوباره و hedge امن است
+        self.verify_endpoint = ResilientEndpoint(
+            "gateway-verify", retry_on=(httpx.TransportError, GatewayError), hedge_percentile=0.95
+        )
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=GATEWAY_BASE_URL, timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def available(self):
+        """False وقتی مدار صدور تراکنش باز است و درخواست جدید فوراً رد می‌شود"""
+        return self.create_endpoint.breaker.state != "open"
+
+    def payment_url(self, transid):
+        """آدرس صفحه پرداخت یک تراکنش"""
+        if self.pin == "sandbox":
+            return f"{GATEWAY_BASE_URL}/startpay/sandbox/{transid}"
+        return f"{GATEWAY_BASE_URL}/startpay/{transid}"
+
+    async def create(self, amount, invoice_id, card_number=None):
+        """صدور تراکنش در درگاه و برگرداندن transid"""
+        data = {
+            "pin": self.pin,
+            "amount": amount,
+            "callback": self.callback_url,
+            "invoice_id": str(invoice_id),
+        }
+        if card_number:
+            data["card_number"] = card_number
+
+        response = await self.create_endpoint.call(lambda: self._post_create(data))
+        try:
+            json_data = response.json()
+        except ValueError:
+            raise GatewayError(f"پاسخ نامعتبر از درگاه: {response.status_code}")
+
+        if response.status_code != 200 or json_data.get('status') != 'success':
+            raise GatewayError(f"صدور تراکنش ناموفق بود: {response.status_code} {json_data}")
+        return json_data['transid']
+
+    async def _post_create(self, data):
+        response = await self.client.post("/api/v2/create", data=data)
+        if response.status_code >= 500:
+            raise GatewayError(f"خطای سرور درگاه: {response.status_code}")
+        return response
+
+    async def verify(self, amount, transid):
+        """
+        وریفای تراکنش و برگرداندن کد وضعیت درگاه
+        1: پرداخت موفق، 0: پرداخت ناموفق، 2: قبلاً وریفای شده
+        """
+        response = await self.verify_endpoint.call(lambda: self._post_verify(amount, transid))
+        try:
+            return int(response.json().get("code", -99))
+        except (ValueError, TypeError):
+            return -99
+
+    async def _post_verify(self, amount, transid):
+        response = await self.client.post("/api/v2/verify", json={
+            "pin": self.pin,
+            "amount": amount,
+            "transid": transid,
+        })
+        if response.status_code != 200:
+            raise GatewayError(f"خطای غیرمنتظره از سمت سرور: {response.status_code}")
+        return response
@@ -0,0 +1,59 @@
+from dataclasses import dataclass
+
+NOBITEX_STATS_URL = "https://api.nobitex.ir/market/stats"
+
+# نام فارسی ارزها برای نمایش در منوها
+CURRENCY_NAMES = {
+    "trx": "ترون",
+    "usdt": "تتر",
+    "btc": "بیت‌کوین",
+    "eth": "اتریوم",
+    "ton": "تون‌کوین",
+}
+
+
+@dataclass(frozen=True)
+class Ticker:
+    """آمار یک بازار؛ قیمت بازارهای ریالی به تومان تبدیل شده است"""
+    market: str
+    best_buy: float
+    best_sell: float
+    latest: float
+
+
+def split_market(market):
+    """جدا کردن نام بازار مثل trx-rls به (ارز مبدا، ارز مقصد)"""
+    src, dst = market.lower().split("-", 1)
+    return src, dst
+
+
+def stats_params(markets):
+    """پارامترهای یک درخواست stats که همه بازارهای داده‌شده را با هم برمی‌گرداند"""
+    pairs = [split_market(market) for market in markets]
+    src = sorted({src for src, _ in pairs})
+    dst = sorted({dst for _, dst in pairs})
+    return {"srcCurrency": ",".join(src), "dstCurrency": ",".join(dst)}
+
+
+def _to_display_units(dst, value):
+    value = float(value)
+    # قیمت بازارهای ریالی به تومان و به صورت عدد صحیح نگه داشته می‌شود
+    return int(value) // 10 if dst == "rls" else value
+
+
+def parse_stats(data, markets):
+    """تبدیل پاسخ stats نوبیتکس به جدول {market: Ticker} فقط برای بازارهای پیکربندی‌شده"""
+    stats = data['stats']
+    table = {}
+    for market in markets:
+        entry = stats.get(market)
+        if not entry or entry.get('isClosed'):
+            continue
+        _, dst = split_market(market)
+        table[market] = Ticker(
+            market=market,
+            best_buy=_to_display_units(dst, entry['bestBuy']),
+            best_sell=_to_display_units(dst, entry['bestSell']),
+            latest=_to_display_units(dst, entry['latest']),
+        )
+    return table
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+
+class MembershipChecker:
+    """
+    بررسی عضویت کاربران در کانال‌های اسپانسر با کش
+    نتیجه هر (کاربر، کانال) با TTL در حافظه نگه داشته می‌شود و در حالت عادی فشردن دکمه‌ها
+    هیچ درخواستی به تلگرام نمی‌فرستد. کانال‌هایی که در کش نیستند همزمان بررسی می‌شوند.
+    رویدادهای ChatMemberUpdated کانال‌هایی که ربات در آن‌ها ادمین است کش را فوراً به‌روز
+    می‌کنند، پس عضویت یا لغو عضویت بدون انتظار برای پایان TTL دیده می‌شود.
+    """
+
+    def __init__(self, channels, member_ttl=600, non_member_ttl=60, max_entries=100000):
+        self.channel_ids = [channel['id'] for channel in channels]
+        self.member_ttl = member_ttl
+        self.non_member_ttl = non_member_ttl
+        self.max_entries = max_entries
+        self._cache = {}
+
+    def _get(self, user_id, channel_id, now):
+        entry = self._cache.get((user_id, channel_id))
+        if entry is None or entry[1] <= now:
+            return None
+        return entry[0]
+
+    def _set(self, user_id, channel_id, is_member):
+        ttl = self.member_ttl if is_member else self.non_member_ttl
+        key = (user_id, channel_id)
+        self._cache.pop(key, None)
+        self._cache[key] = (is_member, time.monotonic() + ttl)
+        # حذف قدیمی‌ترین ورودی‌ها وقتی کش از سقف بزرگ‌تر شود
+        while len(self._cache) > self.max_entries:
+            del self._cache[next(iter(self._cache))]
+
+    async def _check(self, bot, channel_id, user_id):
+        try:
+            member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+        except Exception as e:
+            # خطا کش نمی‌شود تا درخواست بعدی دوباره بررسی کند
+            logger.warning(f"خطا در بررسی عضویت کاربر {user_id} در {channel_id}: {e}")
+            return False
+        is_member = member.status in MEMBER_STATUSES
+        self._set(user_id, channel_id, is_member)
+        return is_member
+
+    async def is_member(self, bot, user_id, force=False):
+        """
+        عضویت کاربر در همه کانال‌ها
+        با force=True (دکمه «بررسی عضویت») نتیجه منفی کش‌شده نادیده گرفته می‌شود.
+        """
+        now = time.monotonic()
+        missing = []
+        for channel_id in self.channel_ids:
+            cached = self._get(user_id, channel_id, now)
+            if cached is None or (force and not cached):
+                missing.append(channel_id)
+            elif not cached:
+                return False
+        if not missing:
+            return True
+        results = await asyncio.gather(*(self._check(bot, channel_id, user_id) for channel_id in missing))
+        return all(results)
+
+    def _channel_key(self, chat):
+        for channel_id in self.channel_ids:
+            if channel_id == chat.id or str(channel_id) == str(chat.id):
+                return channel_id
+            if chat.username and str(channel_id).lower() == f"@{chat.username}".lower():
+                return channel_id
+        return None
+
+    async def on_chat_member(self, update, context):
+        """هندلر ChatMemberHandler: به‌روزرسانی کش با تغییر عضویت در کانال‌های اسپانسر"""
+        change = update.chat_member
+        channel_id = self._channel_key(change.chat)
+        if channel_id is None:
+            return
+        member = change.new_chat_member
+        self._set(member.user.id, channel_id, member.status in MEMBER_STATUSES)
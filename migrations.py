@@ -0,0 +1,205 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ====== دیتابیس فاکتورها ======
+
+INVOICES_TABLE = """
+    CREATE TABLE IF NOT EXISTS invoices (
+        invoice_id TEXT PRIMARY KEY,
+        transid TEXT,
+        amount INTEGER,
+        trx_amount REAL,
+        wallet TEXT,
+        user_id INTEGER,
+        status TEXT,
+        message_chat_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+async def _invoices_v1(db):
+    """ساخت جدول فاکتورها و ترمیم جدول‌هایی که با تعریف بدون کاما ساخته شده‌اند"""
+    columns = {row[1] for row in await db.fetchall("PRAGMA table_info(invoices)")}
+    if not columns or "created_at" in columns:
+        return INVOICES_TABLE
+
+    # در تعریف قدیمی created_at جزو نوع ستون message_chat_id شده بود و
+    # پیش‌فرض CURRENT_TIMESTAMP به message_chat_id رسیده بود؛ همان مقدار زمان ایجاد است.
+    logger.warning("جدول invoices ستون created_at ندارد؛ جدول بازسازی می‌شود.")
+    return INVOICES_TABLE.replace("invoices (", "invoices_repaired (", 1) + """
+        INSERT INTO invoices_repaired
+            (invoice_id, transid, amount, trx_amount, wallet, user_id, status, message_chat_id, created_at)
+        SELECT invoice_id, transid, amount, trx_amount, wallet, user_id, status,
+               CASE WHEN typeof(message_chat_id) = 'integer' THEN message_chat_id END,
+               CASE WHEN typeof(message_chat_id) = 'text' THEN message_chat_id ELSE CURRENT_TIMESTAMP END
+        FROM invoices;
+        DROP TABLE invoices;
+        ALTER TABLE invoices_repaired RENAME TO invoices;
+    """
+
+async def _invoices_v2(db):
+    """ایندکس‌های مسیرهای پرتکرار: لیست تراکنش کاربر، فاکتورهای معلق و کالبک درگاه"""
+    return """
+        CREATE INDEX IF NOT EXISTS idx_invoices_user_created ON invoices (user_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_invoices_status_created ON invoices (status, created_at);
+        CREATE INDEX IF NOT EXISTS idx_invoices_transid ON invoices (transid);
+    """
+
+async def _invoices_v3(db):
+    """افزودن invoice_id به ایندکس کاربر تا صفحه‌بندی keyset بدون مرتب‌سازی موقت انجام شود"""
+    return """
+        DROP INDEX IF EXISTS idx_invoices_user_created;
+        CREATE INDEX idx_invoices_user_created ON invoices (user_id, created_at, invoice_id);
+    """
+
+async def _invoices_v4(db):
+    """ثبت قیمت قفل‌شده‌ای که مبلغ فاکتور از آن محاسبه شده است"""
+    return """
+        ALTER TABLE invoices ADD COLUMN quote_id TEXT;
+        ALTER TABLE invoices ADD COLUMN trx_price INTEGER;
+    """
+
+async def _invoices_v5(db):
+    """
+    صف رویدادهای پرداخت برای ربات
+    تریگر در همان تراکنشی که وضعیت فاکتور paid یا failed می‌شود رویداد را ثبت می‌کند، پس
+    هر پردازشی (کالبک یا وریفای دوره‌ای) که وضعیت را تغییر دهد رویدادش هم از دست نمی‌رود.
+    """
+    return """
+        CREATE TABLE IF NOT EXISTS payment_events (
+            event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            invoice_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivered_at TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_payment_events_pending ON payment_events (event_id) WHERE delivered_at IS NULL;
+        CREATE TRIGGER IF NOT EXISTS invoices_payment_event
+        AFTER UPDATE OF status ON invoices
+        WHEN NEW.status IN ('paid', 'failed') AND OLD.status IS NOT NEW.status
+        BEGIN
+            INSERT INTO payment_events (invoice_id, status) VALUES (NEW.invoice_id, NEW.status);
+        END;
+    """
+
+async def _invoices_v6(db):
+    """نتیجه وریفای هر (فاکتور، transid) تا کالبک‌های تکراری درگاه دوباره وریفای نشوند"""
+    return """
+        CREATE TABLE IF NOT EXISTS payment_callbacks (
+            invoice_id TEXT NOT NULL,
+            transid TEXT NOT NULL,
+            code INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (invoice_id, transid)
+        );
+    """
+
+async def _invoices_v7(db):
+    """
+    شمارنده شماره فاکتورها
+    شمارنده از بزرگ‌ترین شماره فاکتور موجود (شماره‌های تصادفی قدیمی) ادامه پیدا می‌کند تا
+    شماره جدید با هیچ فاکتور قبلی تداخل نداشته باشد.
+    """
+    return """
+        CREATE TABLE IF NOT EXISTS invoice_sequence (
+            name TEXT PRIMARY KEY,
+            next_id INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO invoice_sequence (name, next_id)
+        SELECT 'invoices', max(10000000, coalesce(max(CAST(invoice_id AS INTEGER)), 0) + 1) FROM invoices;
+    """
+
+async def _invoices_v8(db):
+    """کلید یکتای هر خرید تا یک خرید هیچ‌وقت دو فاکتور نداشته باشد"""
+    return """
+        ALTER TABLE invoices ADD COLUMN idempotency_key TEXT;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_invoices_idempotency_key ON invoices (idempotency_key);
+    """
+
+INVOICES_MIGRATIONS = [
+    (1, "جدول فاکتورها", _invoices_v1),
+    (2, "ایندکس‌های فاکتورها", _invoices_v2),
+    (3, "ایندکس صفحه‌بندی تراکنش‌ها", _invoices_v3),
+    (4, "قیمت قفل‌شده فاکتور", _invoices_v4),
+    (5, "رویدادهای پرداخت", _invoices_v5),
+    (6, "نتیجه کالبک‌های درگاه", _invoices_v6),
+    (7, "شمارنده شماره فاکتور", _invoices_v7),
+    (8, "کلید یکتای خرید", _invoices_v8),
+]
+
+# ====== دیتابیس کاربران ======
+
+async def _users_v1(db):
+    """ساخت جدول کاربران"""
+    return """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            role INTEGER DEFAULT 1,
+            phone_number TEXT,
+            card_number TEXT
+        );
+    """
+
+async def _users_v2(db):
+    """جدول هشدارهای قیمت کاربران"""
+    return """
+        CREATE TABLE IF NOT EXISTS price_alerts (
+            alert_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            market TEXT NOT NULL,
+            direction TEXT NOT NULL CHECK (direction IN ('above', 'below')),
+            threshold REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            triggered_at TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_price_alerts_user ON price_alerts (user_id, triggered_at);
+    """
+
+async def _users_v3(db):
+    """جدول جلسه‌های گفتگوی کاربران"""
+    return """
+        CREATE TABLE IF NOT EXISTS sessions (
+            chat_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'idle',
+            trx_amount REAL,
+            wallet TEXT,
+            invoice_id INTEGER,
+            prompt_message_id INTEGER,
+            phone_number TEXT,
+            alert_direction TEXT,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at);
+    """
+
+async def _users_v4(db):
+    """کلید خرید جاری هر جلسه"""
+    return """
+        ALTER TABLE sessions ADD COLUMN purchase_key TEXT;
+    """
+
+USERS_MIGRATIONS = [
+    (1, "جدول کاربران", _users_v1),
+    (2, "هشدارهای قیمت", _users_v2),
+    (3, "جلسه‌های گفتگو", _users_v3),
+    (4, "کلید خرید جلسه", _users_v4),
+]
+
+
+async def migrate(db, migrations):
+    """
+    اعمال مایگریشن‌های اجرا نشده به ترتیب نسخه
+    نسخه فعلی در PRAGMA user_version نگه داشته می‌شود و هر مایگریشن همراه با
+    به‌روزرسانی نسخه در یک تراکنش اجرا می‌شود.
+    """
+    version = (await db.fetchone("PRAGMA user_version"))[0]
+    for target, description, migration in migrations:
+        if target <= version:
+            continue
+        script = await migration(db)
+        await db.executescript(f"BEGIN IMMEDIATE;\n{script}\nPRAGMA user_version = {target};\nCOMMIT;")
+        logger.info(f"مایگریشن {target} ({description}) روی {db.path} اعمال شد.")
+        version = target
+    return version
@@ -0,0 +1,158 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from functools import partial
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# اولویت درخواست‌ها (rate_limit_args)؛ عدد کمتر زودتر ارسال می‌شود
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# متدهایی که در محدودیت ارسال پیام تلگرام حساب می‌شوند
+THROTTLED_PREFIXES = ("send", "edit", "delete", "copy", "forward")
+
+
+class _TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """برداشتن یک توکن؛ خروجی زمان انتظار لازم (صفر یعنی توکن برداشته شد)"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    صف ارسال درخواست‌های ربات با محدودیت نرخ و اولویت
+    - ارسال‌ها (send/edit/delete/...) تابع یک محدودیت کلی و یک محدودیت جدا برای هر چت هستند.
+    - وقتی ظرفیت کلی پر است، درخواست‌های INTERACTIVE (پاسخ به کاربر) جلوتر از درخواست‌های
+      BACKGROUND (اعلان‌های انقضا و هشدار قیمت) ارسال می‌شوند.
+    - حذف تکراری یک پیام به همان درخواست اول می‌پیوندد و دوباره ارسال نمی‌شود.
+    - در صورت خطای RetryAfter کل ارسال‌ها به اندازه زمان اعلام‌شده متوقف و درخواست تکرار می‌شود.
+    """
+
+    def __init__(self, overall_per_second=25, per_chat_per_second=1, per_chat_burst=3, max_retries=3,
+                 coalesce_seconds=60):
+        self.per_chat_per_second = per_chat_per_second
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.coalesce_seconds = coalesce_seconds
+        self._global = _TokenBucket(overall_per_second, overall_per_second)
+        self._chats = {}
+        self._waiters = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._deletes = {}
+        self._dispatcher = None
+
+    async def initialize(self):
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    async def _dispatch(self):
+        """اجازه ارسال به منتظرها به ترتیب اولویت و با نرخ کلی"""
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self._global.take()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # درخواست لغو شده است
+                self._global.refund()
+            else:
+                future.set_result(None)
+
+    async def _acquire_global(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._wakeup.set()
+        await future
+
+    async def _acquire_chat(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # حذف چت‌هایی که مدتی پیامی نداشته‌اند
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_full()}
+            bucket = self._chats[chat_id] = _TokenBucket(self.per_chat_per_second, self.per_chat_burst)
+        while delay := bucket.take():
+            await asyncio.sleep(delay)
+
+    async def _send(self, callback, args, kwargs, endpoint, data, priority):
+        throttled = endpoint.startswith(THROTTLED_PREFIXES)
+        for attempt in range(self.max_retries + 1):
+            if throttled:
+                if data.get("chat_id") is not None:
+                    await self._acquire_chat(data["chat_id"])
+                await self._acquire_global(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"محدودیت ارسال تلگرام برای {endpoint}؛ توقف {e.retry_after} ثانیه‌ای.")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+    def _forget_delete(self, key, future):
+        if future.cancelled() or future.exception() is not None:
+            self._deletes.pop(key, None)
+        else:
+            asyncio.get_running_loop().call_later(self.coalesce_seconds, self._deletes.pop, key, None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = INTERACTIVE if rate_limit_args is None else rate_limit_args
+        if endpoint != "deleteMessage":
+            return await self._send(callback, args, kwargs, endpoint, data, priority)
+
+        key = (str(data.get("chat_id")), data.get("message_id"))
+        future = self._deletes.get(key)
+        if future is None:
+            future = self._deletes[key] = asyncio.ensure_future(
+                self._send(callback, args, kwargs, endpoint, data, priority)
+            )
+            future.add_done_callback(partial(self._forget_delete, key))
+        return await asyncio.shield(future)
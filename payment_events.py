@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+
+def notify(socket_path):
+    """
+    بیدار کردن ربات پس از ثبت نتیجه پرداخت
+    خود رویداد در جدول payment_events ثبت شده است؛ این datagram فقط ربات را بی‌درنگ
+    بیدار می‌کند. اگر ربات در حال اجرا نباشد خطا نادیده گرفته می‌شود و رویداد در شروع
+    بعدی ربات تحویل داده می‌شود.
+    """
+    if not socket_path:
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(b"1", socket_path)
+    except OSError:
+        pass
+
+
+class _WakeupProtocol(asyncio.DatagramProtocol):
+    def __init__(self, event):
+        self.event = event
+
+    def datagram_received(self, data, addr):
+        self.event.set()
+
+
+class PaymentEventConsumer:
+    """
+    دریافت رویدادهای پرداخت در ربات
+    رویدادها از جدول payment_events به ترتیب خوانده و به handler داده می‌شوند و پس از
+    تحویل علامت می‌خورند. با هر datagram روی socket_path صف فوراً خالی می‌شود و هر
+    poll_interval ثانیه هم برای اطمینان بررسی می‌شود.
+    """
+
+    def __init__(self, db, socket_path, poll_interval=30, batch_size=100):
+        self.db = db
+        self.socket_path = socket_path
+        self.handler = None
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._wakeup = asyncio.Event()
+        self._transport = None
+        self._task = None
+
+    async def start(self, handler):
+        """handler(invoice_id, status) برای هر رویداد صدا زده می‌شود"""
+        self.handler = handler
+        if self.socket_path:
+            # فایل سوکت باقی‌مانده از اجرای قبلی
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _WakeupProtocol(self._wakeup), local_addr=self.socket_path, family=socket.AF_UNIX
+            )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    async def drain(self):
+        """تحویل همه رویدادهای تحویل‌نشده"""
+        while True:
+            events = await self.db.fetchall("""
+                SELECT event_id, invoice_id, status FROM payment_events
+                WHERE delivered_at IS NULL
+                ORDER BY event_id LIMIT ?
+            """, (self.batch_size,))
+            if not events:
+                return
+            for event_id, invoice_id, status in events:
+                try:
+                    await self.handler(invoice_id, status)
+                except Exception as e:
+                    logger.error(f"خطا در پردازش رویداد پرداخت فاکتور {invoice_id}: {e}")
+            await self.db.executemany(
+                "UPDATE payment_events SET delivered_at = CURRENT_TIMESTAMP WHERE event_id = ?",
+                [(event_id,) for event_id, _, _ in events],
+            )
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.error(f"خطا در خواندن رویدادهای پرداخت: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+PAID = "paid"
+FAILED = "failed"
+
+# کدهای وریفای درگاه
+VERIFY_FAILED = 0
+VERIFY_SUCCESS = 1
+VERIFY_ALREADY_VERIFIED = 2
+
+VERIFY_MESSAGES = {
+    VERIFY_SUCCESS: "پرداخت شما با موفقیت انجام شد.",
+    VERIFY_FAILED: "پرداخت انجام نشد، لطفاً دوباره تلاش کنید.",
+    VERIFY_ALREADY_VERIFIED: "این تراکنش قبلاً وریفای و تایید شده است.",
+}
+
+
+class PaymentError(Exception):
+    """کالبکی که با هیچ فاکتوری مطابقت ندارد"""
+
+
+def status_for_code(code):
+    """وضعیت فاکتور متناظر با کد وریفای (None برای کدهای نامشخص)"""
+    if code in (VERIFY_SUCCESS, VERIFY_ALREADY_VERIFIED):
+        return PAID
+    if code == VERIFY_FAILED:
+        return FAILED
+    return None
+
+
+async def get_invoice_payment(invoices_db, invoice_id):
+    """مبلغ و transid ثبت‌شده برای فاکتور"""
+    return await invoices_db.fetchone("SELECT amount, transid FROM invoices WHERE invoice_id = ?", (invoice_id,))
+
+
+async def set_invoice_status(invoices_db, invoice_id, status):
+    """
+    ثبت نتیجه پرداخت
+    فاکتور پرداخت‌شده هیچ‌وقت به وضعیت دیگری برنمی‌گردد؛ خروجی True یعنی وضعیت تغییر کرد.
+    """
+    rowcount = await invoices_db.execute(
+        "UPDATE invoices SET status = ? WHERE invoice_id = ? AND status != 'paid' AND status != ?",
+        (status, invoice_id, status),
+    )
+    return rowcount > 0
+
+
+async def verify_payment(invoices_db, gateway, invoice_id, transid):
+    """
+    وریفای پرداخت یک فاکتور در درگاه و ثبت پرداخت موفق در دیتابیس
+    مبلغ از جدول invoices خوانده می‌شود و transid کالبک باید با transid صادرشده یکی باشد.
+    فقط پرداخت تاییدشده قطعی است؛ وریفای ناموفق ممکن است پیش از تسویه پرداخت رخ دهد، پس
+    فاکتور معلق می‌ماند تا کالبک یا وریفای بعدی (یا زمان‌بند انقضا) تعیین وضعیت کند.
+    خروجی: (کد وریفای، PAID یا None)
+    """
+    invoice = await get_invoice_payment(invoices_db, invoice_id)
+    if invoice is None:
+        raise PaymentError(f"فاکتور {invoice_id} پیدا نشد.")
+    amount, expected_transid = invoice
+    if str(expected_transid) != str(transid):
+        raise PaymentError(f"transid کالبک با فاکتور {invoice_id} مطابقت ندارد.")
+
+    code = await gateway.verify(amount, transid)
+    status = PAID if status_for_code(code) == PAID else None
+    if status is not None:
+        await set_invoice_status(invoices_db, invoice_id, status)
+    logger.info(f"نتیجه وریفای فاکتور {invoice_id}: کد {code}، وضعیت {status}")
+    return code, status
+
+
+class PaymentVerifier:
+    """
+    وریفای idempotent کالبک‌های درگاه
+    پرداخت تاییدشده هر (invoice_id, transid) یک بار در جدول payment_callbacks (با کلید یکتا) ثبت
+    می‌شود و نتایج اخیر در حافظه هم نگه داشته می‌شوند؛ کالبک تکراری بدون وریفای دوباره از
+    همان نتیجه پاسخ می‌گیرد و کالبک‌های تکراری همزمان منتظر وریفای در حال اجرا می‌مانند.
+    """
+
+    def __init__(self, invoices_db, gateway, cache_size=4096):
+        self.invoices_db = invoices_db
+        self.gateway = gateway
+        self.cache_size = cache_size
+        self._recent = OrderedDict()
+        self._inflight = {}
+
+    def _remember(self, key, result):
+        self._recent[key] = result
+        self._recent.move_to_end(key)
+        if len(self._recent) > self.cache_size:
+            self._recent.popitem(last=False)
+
+    async def verify(self, invoice_id, transid):
+        """خروجی مثل verify_payment: (کد وریفای، PAID یا None)"""
+        key = (str(invoice_id), str(transid))
+        result = self._recent.get(key)
+        if result is not None:
+            self._recent.move_to_end(key)
+            return result
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            inflight = self._inflight[key] = asyncio.ensure_future(self._verify(key))
+            inflight.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(inflight)
+
+    async def _verify(self, key):
+        stored = await self.invoices_db.fetchone(
+            "SELECT code, status FROM payment_callbacks WHERE invoice_id = ? AND transid = ?", key
+        )
+        if stored is not None:
+            self._remember(key, tuple(stored))
+            return tuple(stored)
+
+        code, status = await verify_payment(self.invoices_db, self.gateway, *key)
+        # فقط پرداخت تاییدشده ثبت می‌شود؛ وریفای ناموفق یا نامشخص در کالبک بعدی تکرار می‌شود
+        if status is not None:
+            await self.invoices_db.execute(
+                "INSERT OR IGNORE INTO payment_callbacks (invoice_id, transid, code, status) VALUES (?, ?, ?, ?)",
+                (*key, code, status),
+            )
+            self._remember(key, (code, status))
+        return code, status
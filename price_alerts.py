@@ -0,0 +1,221 @@
+import asyncio
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+
+logger = logging.getLogger(__name__)
+
+ABOVE = "above"
+BELOW = "below"
+
+
+class _SortedThresholds:
+    """آستانه‌های مرتب یک جهت از یک بازار به همراه شناسه هشدارها (آرایه‌های موازی)"""
+
+    def __init__(self, pairs=()):
+        pairs = sorted(pairs)
+        self.thresholds = array('d', (threshold for threshold, _ in pairs))
+        self.alert_ids = array('q', (alert_id for _, alert_id in pairs))
+
+    def __len__(self):
+        return len(self.thresholds)
+
+    def insert(self, threshold, alert_id):
+        i = bisect_right(self.thresholds, threshold)
+        self.thresholds.insert(i, threshold)
+        self.alert_ids.insert(i, alert_id)
+
+    def remove(self, threshold, alert_id):
+        i = bisect_left(self.thresholds, threshold)
+        j = bisect_right(self.thresholds, threshold)
+        for k in range(i, j):
+            if self.alert_ids[k] == alert_id:
+                del self.thresholds[k]
+                del self.alert_ids[k]
+                return True
+        return False
+
+    def pop_prefix(self, end):
+        """برداشتن هشدارهای [0, end)"""
+        ids = self.alert_ids[:end].tolist()
+        del self.thresholds[:end]
+        del self.alert_ids[:end]
+        return ids
+
+    def pop_suffix(self, start):
+        """برداشتن هشدارهای [start, len)"""
+        ids = self.alert_ids[start:].tolist()
+        del self.thresholds[start:]
+        del self.alert_ids[start:]
+        return ids
+
+
+class AlertIndex:
+    """
+    ایندکس درون‌حافظه‌ای هشدارهای قیمت
+    برای هر بازار دو آرایه مرتب نگه داشته می‌شود: هشدارهای «بالاتر از» که با رسیدن قیمت به
+    آستانه یا بیشتر فعال می‌شوند و هشدارهای «پایین‌تر از». با هر قیمت جدید فقط با یک
+    bisect مرز هشدارهای فعال‌شده پیدا می‌شود و همان بخش از آرایه برداشته می‌شود؛ بقیه
+    هشدارها اصلاً لمس نمی‌شوند.
+    """
+
+    def __init__(self):
+        self._markets = {}
+        self._alerts = {}
+
+    def __len__(self):
+        return len(self._alerts)
+
+    def _sides(self, market):
+        sides = self._markets.get(market)
+        if sides is None:
+            sides = self._markets[market] = {ABOVE: _SortedThresholds(), BELOW: _SortedThresholds()}
+        return sides
+
+    def load(self, alerts):
+        """ساخت یکجای ایندکس از سطرهای (alert_id, user_id, market, direction, threshold)"""
+        grouped = {}
+        for alert_id, user_id, market, direction, threshold in alerts:
+            self._alerts[alert_id] = (user_id, market, direction, threshold)
+            grouped.setdefault((market, direction), []).append((threshold, alert_id))
+        for (market, direction), pairs in grouped.items():
+            self._sides(market)[direction] = _SortedThresholds(pairs)
+
+    def add(self, alert_id, user_id, market, direction, threshold):
+        self._alerts[alert_id] = (user_id, market, direction, threshold)
+        self._sides(market)[direction].insert(threshold, alert_id)
+
+    def remove(self, alert_id):
+        alert = self._alerts.pop(alert_id, None)
+        if alert is None:
+            return None
+        _, market, direction, threshold = alert
+        self._sides(market)[direction].remove(threshold, alert_id)
+        return alert
+
+    def get(self, alert_id):
+        return self._alerts.get(alert_id)
+
+    def crossed(self, market, price):
+        """
+        برداشتن و برگرداندن هشدارهایی که با قیمت price فعال شده‌اند
+        خروجی: لیست (alert_id, user_id, direction, threshold)
+        """
+        sides = self._markets.get(market)
+        if sides is None:
+            return []
+        above, below = sides[ABOVE], sides[BELOW]
+        ids = above.pop_prefix(bisect_right(above.thresholds, price))
+        ids += below.pop_suffix(bisect_left(below.thresholds, price))
+        triggered = []
+        for alert_id in ids:
+            user_id, _, direction, threshold = self._alerts.pop(alert_id)
+            triggered.append((alert_id, user_id, direction, threshold))
+        return triggered
+
+
+class PriceAlerts:
+    """
+    ثبت، نگهداری و ارزیابی هشدارهای قیمت کاربران
+    هشدارها در users.db ذخیره می‌شوند و در شروع ربات در AlertIndex بارگذاری می‌شوند. هشدار
+    یک‌بارمصرف است؛ پس از فعال شدن در دیتابیس علامت می‌خورد و پیام‌ها در دسته‌هایی با
+    نرخ محدود ارسال می‌شوند تا از محدودیت تلگرام عبور نکنند.
+    """
+
+    def __init__(self, db, format_message, max_alerts_per_user=10, send_batch_size=25, batch_interval=1.0,
+                 rate_limit_args=None):
+        self.db = db
+        self.format_message = format_message
+        self.max_alerts_per_user = max_alerts_per_user
+        self.send_batch_size = send_batch_size
+        self.batch_interval = batch_interval
+        # اولویت پیام‌ها در rate limiter ربات (اگر تنظیم شده باشد)
+        self.rate_limit_args = rate_limit_args
+        self.index = AlertIndex()
+        self._bot = None
+        self._outbox = asyncio.Queue()
+        self._sender_task = None
+        self._pending_writes = set()
+
+    async def start(self, bot):
+        """بارگذاری هشدارهای فعال و شروع تسک ارسال پیام"""
+        self._bot = bot
+        rows = await self.db.fetchall("""
+            SELECT alert_id, user_id, market, direction, threshold FROM price_alerts
+            WHERE triggered_at IS NULL
+        """)
+        self.index.load(rows)
+        logger.info(f"{len(self.index)} هشدار قیمت فعال بارگذاری شد.")
+        self._sender_task = asyncio.create_task(self._send_loop())
+
+    async def stop(self):
+        if self._sender_task is not None:
+            self._sender_task.cancel()
+            try:
+                await self._sender_task
+            except asyncio.CancelledError:
+                pass
+            self._sender_task = None
+
+    async def user_alerts(self, user_id):
+        """هشدارهای فعال یک کاربر"""
+        return await self.db.fetchall("""
+            SELECT alert_id, market, direction, threshold FROM price_alerts
+            WHERE user_id = ? AND triggered_at IS NULL
+            ORDER BY alert_id
+        """, (user_id,))
+
+    async def add(self, user_id, market, direction, threshold):
+        """ثبت هشدار جدید؛ اگر کاربر به سقف تعداد هشدار رسیده باشد None برمی‌گردد"""
+        if len(await self.user_alerts(user_id)) >= self.max_alerts_per_user:
+            return None
+        rows = await self.db.execute_returning("""
+            INSERT INTO price_alerts (user_id, market, direction, threshold) VALUES (?, ?, ?, ?)
+            RETURNING alert_id
+        """, (user_id, market, direction, threshold))
+        alert_id = rows[0][0]
+        self.index.add(alert_id, user_id, market, direction, threshold)
+        return alert_id
+
+    async def cancel(self, user_id, alert_id):
+        """لغو هشدار کاربر"""
+        alert = self.index.get(alert_id)
+        if alert is None or alert[0] != user_id:
+            return False
+        self.index.remove(alert_id)
+        await self.db.execute("DELETE FROM price_alerts WHERE alert_id = ?", (alert_id,))
+        return True
+
+    def on_price(self, market, timestamp, price):
+        """listener سرویس قیمت: ارزیابی هشدارها با قیمت جدید"""
+        triggered = self.index.crossed(market, price)
+        if not triggered:
+            return
+        for alert_id, user_id, direction, threshold in triggered:
+            self._outbox.put_nowait((user_id, self.format_message(market, direction, threshold, price)))
+        task = asyncio.create_task(self._mark_triggered([alert_id for alert_id, *_ in triggered]))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._pending_writes.discard)
+
+    async def _mark_triggered(self, alert_ids):
+        try:
+            await self.db.executemany(
+                "UPDATE price_alerts SET triggered_at = CURRENT_TIMESTAMP WHERE alert_id = ?",
+                [(alert_id,) for alert_id in alert_ids],
+            )
+        except Exception as e:
+            logger.error(f"خطا در ثبت فعال شدن هشدارها: {e}")
+
+    async def _send(self, user_id, text):
+        try:
+            await self._bot.send_message(chat_id=user_id, text=text, rate_limit_args=self.rate_limit_args)
+        except Exception as e:
+            logger.error(f"خطا در ارسال هشدار قیمت به کاربر {user_id}: {e}")
+
+    async def _send_loop(self):
+        while True:
+            batch = [await self._outbox.get()]
+            while len(batch) < self.send_batch_size and not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+            await asyncio.gather(*(self._send(user_id, text) for user_id, text in batch))
+            await asyncio.sleep(self.batch_interval)
@@ -0,0 +1,122 @@
+import logging
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+_HEADER = struct.Struct("<4sIII")
+_MAGIC = b"PRH1"
+
+
+class PriceHistory:
+    """
+    تاریخچه فشرده قیمت در حافظه
+    زمان‌ها در array('d') و قیمت‌های صحیح تومانی در array('q') به صورت بافر حلقوی با
+    ظرفیت ثابت نگه داشته می‌شوند؛ حافظه ثابت است و آمار هر بازه با جستجوی دودویی روی
+    زمان‌ها و یک پیمایش خطی روی همان بازه محاسبه می‌شود، بدون هیچ درخواست شبکه‌ای.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._times = array('d', bytes(8 * capacity))
+        self._prices = array('q', bytes(8 * capacity))
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, timestamp, price):
+        """افزودن یک قیمت؛ در صورت پر بودن بافر قدیمی‌ترین نقطه جایگزین می‌شود"""
+        if self._size and timestamp < self._time_at(self._size - 1):
+            return
+        index = (self._start + self._size) % self.capacity
+        self._times[index] = timestamp
+        self._prices[index] = int(price)
+        if self._size < self.capacity:
+            self._size += 1
+        else:
+            self._start = (self._start + 1) % self.capacity
+
+    def _time_at(self, i):
+        return self._times[(self._start + i) % self.capacity]
+
+    def _price_at(self, i):
+        return self._prices[(self._start + i) % self.capacity]
+
+    def window(self, seconds, now=None):
+        """قیمت‌های ثبت‌شده در seconds ثانیه اخیر به ترتیب زمانی"""
+        cutoff = (time.time() if now is None else now) - seconds
+        first = bisect_left(range(self._size), cutoff, key=self._time_at)
+        return [self._price_at(i) for i in range(first, self._size)]
+
+    def stats(self, seconds, now=None):
+        """کمترین، بیشترین و درصد تغییر در بازه (None اگر داده‌ای نباشد)"""
+        prices = self.window(seconds, now)
+        if not prices:
+            return None
+        first, last = prices[0], prices[-1]
+        change = (last - first) * 100 / first if first else 0.0
+        return {"min": min(prices), "max": max(prices), "first": first, "last": last, "change": change}
+
+    def sparkline(self, seconds, width=16, now=None):
+        """نمودار متنی کوچک از روند قیمت در بازه"""
+        prices = self.window(seconds, now)
+        if len(prices) < 2:
+            return ""
+        # هر ستون آخرین قیمت بخش متناظر از بازه است
+        step = len(prices) / min(width, len(prices))
+        points = [prices[min(len(prices) - 1, int((i + 1) * step) - 1)] for i in range(min(width, len(prices)))]
+        low, high = min(points), max(points)
+        if high == low:
+            return SPARK_CHARS[len(SPARK_CHARS) // 2] * len(points)
+        scale = (len(SPARK_CHARS) - 1) / (high - low)
+        return "".join(SPARK_CHARS[int((p - low) * scale)] for p in points)
+
+    # ====== ذخیره روی دیسک ======
+
+    def dumps(self):
+        """تبدیل محتوای بافر (به ترتیب زمانی) به بایت برای ذخیره"""
+        times = array('d', (self._time_at(i) for i in range(self._size)))
+        prices = array('q', (self._price_at(i) for i in range(self._size)))
+        return _HEADER.pack(_MAGIC, 1, self.capacity, self._size) + times.tobytes() + prices.tobytes()
+
+    def loads(self, data):
+        """بارگذاری بایت‌های ذخیره‌شده با dumps"""
+        magic, _, _, size = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("فایل تاریخچه قیمت معتبر نیست.")
+        offset = _HEADER.size
+        times = array('d')
+        times.frombytes(data[offset:offset + 8 * size])
+        prices = array('q')
+        prices.frombytes(data[offset + 8 * size:offset + 16 * size])
+        for timestamp, price in zip(times, prices):
+            self.append(timestamp, price)
+
+    @staticmethod
+    def write(path, data):
+        """نوشتن اتمیک بایت‌های dumps روی دیسک (قابل اجرا در thread جدا)"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def save(self, path):
+        """ذخیره اتمیک snapshot روی دیسک"""
+        self.write(path, self.dumps())
+
+    def load(self, path):
+        """بارگذاری آخرین snapshot در صورت وجود"""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as f:
+                self.loads(f.read())
+            logger.info(f"{self._size} نقطه از تاریخچه قیمت بارگذاری شد.")
+        except (OSError, ValueError, struct.error) as e:
+            logger.error(f"خطا در بارگذاری تاریخچه قیمت: {e}")
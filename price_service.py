@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import secrets
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+import httpx
+
+from market_data import NOBITEX_STATS_URL, parse_stats, stats_params
+from resilience import ResilientEndpoint
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MARKET = "trx-rls"
+
+
+class NobitexError(Exception):
+    """پاسخ ناموفق از API نوبیتکس"""
+
+
+@dataclass(frozen=True)
+class Quote:
+    """قیمت قفل‌شده‌ای که از انتخاب روش کارمزد تا ثبت فاکتور همراه خرید می‌ماند"""
+    quote_id: str
+    market: str
+    price: int
+    issued_at: float
+    expires_at: float
+
+    def is_expired(self, now=None):
+        return (time.time() if now is None else now) >= self.expires_at
+
+
+class PriceService:
+    """
+    قیمت لحظه‌ای بازارها با کش در حافظه
+    یک تسک پس‌زمینه آمار همه بازارهای پیکربندی‌شده را هر refresh_interval ثانیه با یک
+    درخواست stats از نوبیتکس می‌گیرد و در جدول tickers نگه می‌دارد؛ خواندن‌ها از حافظه
+    انجام می‌شود. اگر جدول کهنه‌تر از max_age باشد، درخواست‌های همزمان منتظر یک
+    درخواست مشترک می‌مانند (single-flight) و هیچ‌وقت چند درخواست موازی به API نمی‌رود.
+    """
+
+    def __init__(self, markets=(DEFAULT_MARKET,), refresh_interval=30, max_age=120, quote_ttl=120, timeout=10):
+        self.markets = list(dict.fromkeys(market.lower() for market in markets))
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.quote_ttl = quote_ttl
+        self.timeout = timeout
+        self.tickers = {}
+        self.updated_at = None
+        self._updated_monotonic = None
+        self._inflight = None
+        self._client = None
+        self._task = None
+        self._listeners = []
+        # درخواست stats فقط خواندنی است، پس تلاش دوباره و hedge برایش امن است
+        self.endpoint = ResilientEndpoint(
+            "nobitex-stats", retry_on=(httpx.TransportError, NobitexError), hedge_percentile=0.95
+        )
+
+    def add_listener(self, listener, market=DEFAULT_MARKET):
+        """ثبت تابعی که بعد از هر دریافت موفق با (timestamp, price) بازار داده‌شده صدا زده می‌شود"""
+        self._listeners.append((market, listener))
+
+    async def start(self):
+        """ساخت کلاینت HTTP و شروع به‌روزرسانی پس‌زمینه"""
+        self._client = httpx.AsyncClient(timeout=self.timeout)
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def age(self):
+        """عمر قیمت فعلی به ثانیه (None اگر هنوز قیمتی دریافت نشده)"""
+        if self._updated_monotonic is None:
+            return None
+        return time.monotonic() - self._updated_monotonic
+
+    def is_fresh(self, max_age=None):
+        age = self.age
+        return age is not None and age <= (self.max_age if max_age is None else max_age)
+
+    @property
+    def price(self):
+        """آخرین قیمت خرید ترون به تومان (بدون بررسی تازگی)"""
+        ticker = self.tickers.get(DEFAULT_MARKET)
+        return ticker.best_buy if ticker else None
+
+    async def get_ticker(self, market=DEFAULT_MARKET, max_age=None):
+        """
+        آمار یک بازار از جدول
+        اگر جدول کش‌شده تازه نباشد یک بار به‌روزرسانی می‌شود؛ در صورت خطا None برمی‌گردد
+        تا قیمت کهنه هیچ‌وقت برای صدور فاکتور استفاده نشود.
+        """
+        if not self.is_fresh(max_age):
+            await self.refresh()
+        return self.tickers.get(market) if self.is_fresh(max_age) else None
+
+    async def get_price(self, market=DEFAULT_MARKET, max_age=None):
+        """بهترین قیمت خرید یک بازار (برای بازارهای ریالی به تومان)"""
+        ticker = await self.get_ticker(market, max_age)
+        return ticker.best_buy if ticker else None
+
+    async def issue_quote(self, market=DEFAULT_MARKET):
+        """صدور یک Quote از قیمت تازه (None اگر قیمت تازه‌ای در دسترس نباشد)"""
+        price = await self.get_price(market)
+        if price is None:
+            return None
+        now = time.time()
+        return Quote(
+            quote_id=secrets.token_hex(6), market=market, price=price, issued_at=now, expires_at=now + self.quote_ttl
+        )
+
+    async def refresh(self):
+        """دریافت قیمت؛ فراخوان‌های همزمان به یک درخواست مشترک می‌پیوندند"""
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._fetch())
+            self._inflight.add_done_callback(self._clear_inflight)
+        try:
+            return await asyncio.shield(self._inflight)
+        except Exception as e:
+            logger.error(f"Error fetching market prices: {e}")
+            return None
+
+    def _clear_inflight(self, future):
+        self._inflight = None
+
+    async def _request(self):
+        # همه بازارها با یک درخواست گرفته می‌شوند
+        response = await self._client.get(NOBITEX_STATS_URL, params=stats_params(self.markets))
+        if response.status_code != 200:
+            raise NobitexError(f"API Error: {response.status_code}")
+        return response.json()
+
+    async def _fetch(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        tickers = parse_stats(await self.endpoint.call(self._request), self.markets)
+        if DEFAULT_MARKET in self.markets and DEFAULT_MARKET not in tickers:
+            raise Exception(f"بازار {DEFAULT_MARKET} در پاسخ API نبود")
+        self.tickers = tickers
+        self.updated_at = datetime.now()
+        self._updated_monotonic = time.monotonic()
+        timestamp = time.time()
+        for market, listener in self._listeners:
+            ticker = tickers.get(market)
+            if ticker is None:
+                continue
+            try:
+                listener(timestamp, ticker.best_buy)
+            except Exception as e:
+                logger.error(f"خطا در listener قیمت: {e}")
+        return tickers
+
+    async def _refresh_loop(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import logging
+
+from db import Database
+from gateway import AqayepardakhtClient
+from payment_events import notify
+from payments import PAID, status_for_code
+
+logger = logging.getLogger(__name__)
+
+
+class Reconciler:
+    """
+    وریفای دوره‌ای فاکتورهایی که کالبک آن‌ها نرسیده است
+    در هر دور فاکتورهای معلق دارای transid (و فاکتورهای اخیراً لغوشده، اگر پرداخت بعد از
+    انقضا انجام شده باشد) با حداکثر concurrency درخواست همزمان وریفای می‌شوند و همه
+    پرداخت‌های تاییدشده در یک تراکنش ثبت می‌شوند. این worker در پردازه جداگانه اجرا
+    می‌شود تا بار آن روی حلقه رویداد ربات نباشد.
+    """
+
+    def __init__(self, invoices_db, gateway, events_socket=None, concurrency=20, min_age_seconds=60,
+                 canceled_lookback_minutes=60, max_invoices=5000):
+        self.invoices_db = invoices_db
+        self.gateway = gateway
+        self.events_socket = events_socket
+        self.concurrency = concurrency
+        self.min_age_seconds = min_age_seconds
+        self.canceled_lookback_minutes = canceled_lookback_minutes
+        self.max_invoices = max_invoices
+
+    async def candidates(self):
+        """فاکتورهای قابل وریفای؛ فاکتورهای تازه فرصت دریافت کالبک خود را دارند"""
+        return await self.invoices_db.fetchall("""
+            SELECT invoice_id, transid, amount FROM invoices
+            WHERE transid IS NOT NULL
+              AND created_at <= datetime('now', ?)
+              AND (status = 'pending' OR (status = 'canceled' AND created_at >= datetime('now', ?)))
+            ORDER BY created_at
+            LIMIT ?
+        """, (f"-{self.min_age_seconds} seconds", f"-{self.canceled_lookback_minutes} minutes", self.max_invoices))
+
+    async def _verify(self, semaphore, invoice_id, transid, amount):
+        async with semaphore:
+            try:
+                return invoice_id, transid, await self.gateway.verify(amount, transid)
+            except Exception as e:
+                logger.warning(f"وریفای فاکتور {invoice_id} ناموفق بود: {e}")
+                return invoice_id, transid, None
+
+    async def run_once(self):
+        """یک دور وریفای؛ خروجی تعداد فاکتورهایی که پرداخت‌شده ثبت شدند"""
+        invoices = await self.candidates()
+        if not invoices:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._verify(semaphore, *invoice) for invoice in invoices))
+
+        # فقط پرداخت تاییدشده اعمال می‌شود؛ فاکتور پرداخت‌نشده به زمان‌بند انقضا سپرده می‌شود
+        paid = [(str(invoice_id), str(transid), code) for invoice_id, transid, code in results
+                if code is not None and status_for_code(code) == PAID]
+        if not paid:
+            logger.info(f"{len(invoices)} فاکتور وریفای شد؛ پرداخت جدیدی پیدا نشد.")
+            return 0
+
+        updated, _ = await self.invoices_db.transaction([
+            ("UPDATE invoices SET status = 'paid' WHERE invoice_id = ? AND status != 'paid'",
+             [(invoice_id,) for invoice_id, _, _ in paid]),
+            ("INSERT OR IGNORE INTO payment_callbacks (invoice_id, transid, code, status) VALUES (?, ?, ?, 'paid')",
+             paid),
+        ])
+        logger.info(f"{len(invoices)} فاکتور وریفای شد؛ {updated} پرداخت جدید ثبت شد.")
+        if updated:
+            notify(self.events_socket)
+        return updated
+
+    async def run_forever(self, interval):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"خطا در دور وریفای فاکتورها: {e}")
+            await asyncio.sleep(interval)
+
+
+async def main():
+    with open('config.json', 'r', encoding='utf-8') as config_file:
+        config = json.load(config_file)
+
+    invoices_db = Database(config['invoices'])
+    gateway = AqayepardakhtClient(
+        config.get('gateway_pin', 'sandbox'), config.get('gateway_callback_url', 'http://127.0.0.1:5000/callback')
+    )
+    reconciler = Reconciler(
+        invoices_db,
+        gateway,
+        events_socket=config.get('events_socket', 'payment_events.sock'),
+        concurrency=config.get('reconcile_concurrency', 20),
+    )
+    await invoices_db.connect()
+    try:
+        await reconciler.run_forever(config.get('reconcile_interval_seconds', 60))
+    finally:
+        await gateway.close()
+        await invoices_db.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    asyncio.run(main())
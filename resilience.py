@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """مدار سرویس باز است و درخواست بدون تماس با سرویس رد شد"""
+
+
+class CircuitBreaker:
+    """
+    قطع‌کننده مدار برای یک endpoint
+    بعد از failure_threshold خطای پشت سر هم مدار باز می‌شود و تا reset_timeout ثانیه همه
+    درخواست‌ها فوراً رد می‌شوند. سپس یک درخواست آزمایشی (half-open) اجازه عبور دارد؛ موفقیت
+    آن مدار را می‌بندد و شکستش دوباره مدار را باز می‌کند.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def release_probe(self):
+        """آزاد کردن درخواست آزمایشی بی‌نتیجه (مثلاً لغوشده) تا درخواست بعدی جای آن را بگیرد"""
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._probing or self._failures >= self.failure_threshold:
+            if self._opened_at is None or self._probing:
+                logger.warning(f"مدار {self.name} باز شد.")
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class RetryBudget:
+    """
+    بودجه تلاش دوباره
+    هر درخواست اصلی ratio توکن به بودجه اضافه می‌کند و هر تلاش دوباره (یا درخواست hedge)
+    یک توکن مصرف می‌کند؛ پس در زمان خرابی سرویس تعداد تلاش‌های اضافه حداکثر درصد ثابتی
+    از ترافیک است و سرویس در حال خرابی بمباران نمی‌شود.
+    """
+
+    def __init__(self, ratio=0.2, initial_tokens=3, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = initial_tokens
+
+    def deposit(self):
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+class LatencyTracker:
+    """نگهداری تأخیر آخرین درخواست‌های موفق برای محاسبه صدک"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, p):
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+class ResilientEndpoint:
+    """
+    اجرای درخواست‌های یک endpoint خارجی با قطع‌کننده مدار، تلاش دوباره و hedge
+    - وقتی مدار باز است CircuitOpenError فوراً برمی‌گردد.
+    - فقط خطاهای retry_on دوباره تلاش می‌شوند، با تأخیر تصادفی (full jitter) و تا جایی که
+      بودجه تلاش دوباره اجازه دهد.
+    - اگر hedge_percentile داده شود و درخواست از آن صدک تأخیر طولانی‌تر شود، یک درخواست
+      دوم موازی فرستاده می‌شود و اولین پاسخ موفق استفاده می‌شود. فقط برای درخواست‌های
+      idempotent مناسب است.
+    """
+
+    def __init__(self, name, retry_on=(Exception,), max_attempts=3, base_delay=0.2, max_delay=2.0,
+                 hedge_percentile=None, min_hedge_samples=20, breaker=None, budget=None):
+        self.name = name
+        self.retry_on = retry_on
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_samples = min_hedge_samples
+        self.breaker = breaker or CircuitBreaker(name)
+        self.budget = budget or RetryBudget()
+        self.latency = LatencyTracker()
+
+    async def call(self, request):
+        """اجرای request (یک تابع بدون آرگومان که coroutine برمی‌گرداند)"""
+        probe = self.breaker.state == "half-open"
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"سرویس {self.name} موقتاً در دسترس نیست.")
+        self.budget.deposit()
+
+        for attempt in range(self.max_attempts):
+            try:
+                result = await self._attempt(request)
+            except Exception as e:
+                # هر خطا در مدار شمرده می‌شود، ولی فقط خطاهای retry_on دوباره تلاش می‌شوند
+                self.breaker.record_failure()
+                last_attempt = attempt == self.max_attempts - 1
+                if (not isinstance(e, self.retry_on) or last_attempt
+                        or not self.breaker.allow() or not self.budget.withdraw()):
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logger.warning(f"خطا در {self.name} ({e})؛ تلاش دوباره پس از {delay:.2f} ثانیه.")
+                await asyncio.sleep(delay)
+            except BaseException:
+                # لغو درخواست (CancelledError) چیزی درباره سلامت سرویس نمی‌گوید
+                if probe:
+                    self.breaker.release_probe()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def _timed(self, request):
+        started = time.monotonic()
+        result = await request()
+        self.latency.record(time.monotonic() - started)
+        return result
+
+    async def _attempt(self, request):
+        if self.hedge_percentile is None or len(self.latency) < self.min_hedge_samples:
+            return await self._timed(request)
+
+        hedge_after = self.latency.percentile(self.hedge_percentile)
+        tasks = {asyncio.ensure_future(self._timed(request))}
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done and self.budget.withdraw():
+            tasks.add(asyncio.ensure_future(self._timed(request)))
+
+        error = None
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
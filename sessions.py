@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import astuple, dataclass, fields
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class Session:
+    """وضعیت گفتگوی یک چت (مرحله خرید، ثبت‌نام یا هشدار قیمت)"""
+    chat_id: int
+    status: str = "idle"
+    trx_amount: float = None
+    wallet: str = None
+    invoice_id: int = None
+    prompt_message_id: int = None
+    phone_number: str = None
+    alert_direction: str = None
+    purchase_key: str = None
+    updated_at: float = 0.0
+
+    def is_empty(self):
+        return self == Session(self.chat_id, updated_at=self.updated_at)
+
+
+_COLUMNS = [field.name for field in fields(Session)]
+_UPSERT = (
+    f"INSERT INTO sessions ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))}) "
+    f"ON CONFLICT (chat_id) DO UPDATE SET "
+    + ", ".join(f"{column} = excluded.{column}" for column in _COLUMNS[1:])
+)
+
+
+class SessionStore:
+    """
+    نگهداری وضعیت گفتگوی چت‌ها با حافظه محدود
+    جلسه‌های فعال در یک OrderedDict به ترتیب آخرین استفاده نگه داشته می‌شوند؛ جلسه‌هایی
+    که بیش از ttl ثانیه بی‌استفاده مانده‌اند یا از سقف max_sessions بیرون می‌افتند از حافظه
+    حذف می‌شوند. تغییرات با تأخیر flush_interval به صورت دسته‌ای در جدول sessions نوشته
+    می‌شوند (write-behind) تا بعد از ری‌استارت، کاربر از همان مرحله ادامه دهد.
+    """
+
+    def __init__(self, db, ttl=24 * 3600, max_sessions=10000, flush_interval=2.0):
+        self.db = db
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.flush_interval = flush_interval
+        self._sessions = OrderedDict()
+        self._dirty = {}
+        self._task = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def start(self):
+        """پاک کردن جلسه‌های منقضی از دیتابیس و شروع تسک نوشتن"""
+        await self.db.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def _expired(self, session, now):
+        return session.updated_at + self.ttl < now
+
+    def _put(self, session):
+        self._sessions[session.chat_id] = session
+        self._sessions.move_to_end(session.chat_id)
+        while len(self._sessions) > self.max_sessions:
+            # جلسه حذف‌شده اگر هنوز نوشته نشده باشد در _dirty می‌ماند
+            self._sessions.popitem(last=False)
+
+    async def get(self, chat_id):
+        """جلسه چت؛ اگر وجود نداشته باشد یا منقضی شده باشد جلسه خالی برمی‌گردد"""
+        now = time.time()
+        session = self._sessions.get(chat_id) or self._dirty.get(chat_id)
+        if session is None:
+            row = await self.db.fetchone(f"SELECT {', '.join(_COLUMNS)} FROM sessions WHERE chat_id = ?", (chat_id,))
+            session = Session(*row) if row else Session(chat_id, updated_at=now)
+        if self._expired(session, now):
+            session = Session(chat_id, updated_at=now)
+        self._put(session)
+        return session
+
+    def _touch(self, session):
+        session.updated_at = time.time()
+        self._put(session)
+        self._dirty[session.chat_id] = session
+        return session
+
+    async def update(self, chat_id, **values):
+        """تغییر چند فیلد جلسه"""
+        session = await self.get(chat_id)
+        for name, value in values.items():
+            setattr(session, name, value)
+        return self._touch(session)
+
+    async def reset(self, chat_id, status="idle", **values):
+        """شروع یک مرحله جدید: همه فیلدهای قبلی پاک می‌شوند"""
+        return self._touch(Session(chat_id, status=status, **values))
+
+    async def flush(self):
+        """نوشتن جلسه‌های تغییرکرده در دیتابیس"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        upserts = [astuple(session) for session in dirty.values() if not session.is_empty()]
+        # جلسه‌های خالی (idle بدون داده) ذخیره نمی‌شوند تا جدول کوچک بماند
+        deletes = [(session.chat_id,) for session in dirty.values() if session.is_empty()]
+        try:
+            if upserts:
+                await self.db.executemany(_UPSERT, upserts)
+            if deletes:
+                await self.db.executemany("DELETE FROM sessions WHERE chat_id = ?", deletes)
+        except Exception as e:
+            logger.error(f"خطا در ذخیره جلسه‌ها: {e}")
+            for chat_id, session in dirty.items():
+                self._dirty.setdefault(chat_id, session)
+
+    def _evict_expired(self):
+        now = time.time()
+        while self._sessions:
+            chat_id, session = next(iter(self._sessions.items()))
+            if not self._expired(session, now):
+                break
+            del self._sessions[chat_id]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._evict_expired()
+            await self.flush()
@@ -0,0 +1,58 @@
+import asyncio
+import sys
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    پردازش همزمان آپدیت‌های چت‌های مختلف با حفظ ترتیب در هر چت
+    آپدیت‌های یک چت پشت یک قفل FIFO مخصوص همان چت صف می‌کشند، پس مراحل گفتگو (مقدار ترون،
+    آدرس ولت، روش کارمزد) هیچ‌وقت با هم تداخل نمی‌کنند؛ آپدیت‌های چت‌های دیگر تا سقف
+    max_concurrent_updates همزمان اجرا می‌شوند.
+    """
+
+    __slots__ = ("_chat_locks", "_slots")
+
+    def __init__(self, max_concurrent_updates):
+        # سمافور کلاس پایه عملاً نامحدود است و سقف همزمانی در do_process_update و پس از قفل
+        # چت اعمال می‌شود تا آپدیت‌های صف‌کشیده یک چت جای چت‌های دیگر را اشغال نکنند
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # chat_id -> [قفل، تعداد آپدیت‌های در انتظار یا در حال اجرا]
+        self._chat_locks = {}
+
+    @staticmethod
+    def _chat_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+
+
+@dataclass(frozen=True)
+class UserProfile:
+    """اطلاعات ثبت‌نامی یک کاربر از users.db"""
+    user_id: int
+    role: int
+    phone_number: str
+    card_number: str
+
+
+class UserCache:
+    """
+    کش LRU پروفایل کاربران با نوشتن مستقیم (write-through)
+    پروفایل هر کاربر بار اول از دیتابیس خوانده می‌شود و بعد از آن از حافظه برمی‌گردد؛
+    ثبت‌نام و ویرایش کارت ابتدا در دیتابیس نوشته و سپس در کش اعمال می‌شوند، پس کش همیشه
+    با دیتابیس یکسان است. با رسیدن به max_size کاربری که دیرتر از همه استفاده شده حذف می‌شود.
+    """
+
+    def __init__(self, db, max_size=10000):
+        self.db = db
+        self.max_size = max_size
+        self._profiles = OrderedDict()
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def _put(self, profile):
+        self._profiles[profile.user_id] = profile
+        self._profiles.move_to_end(profile.user_id)
+        if len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+
+    async def get(self, user_id):
+        """پروفایل کاربر (None اگر ثبت‌نام نکرده باشد)"""
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            self._profiles.move_to_end(user_id)
+            return profile
+        row = await self.db.fetchone(
+            "SELECT user_id, role, phone_number, card_number FROM users WHERE user_id = ?", (user_id,)
+        )
+        if row is None:
+            return None
+        profile = UserProfile(*row)
+        self._put(profile)
+        return profile
+
+    async def register(self, user_id, phone_number, card_number):
+        """ثبت کاربر جدید با نقش پیش‌فرض"""
+        await self.db.execute(
+            "INSERT INTO users (user_id, phone_number, card_number) VALUES (?, ?, ?)",
+            (user_id, phone_number, card_number),
+        )
+        # خواندن دوباره تا مقدار پیش‌فرض role از خود دیتابیس بیاید
+        self._profiles.pop(user_id, None)
+        return await self.get(user_id)
+
+    async def update_card(self, user_id, card_number):
+        """ویرایش شماره کارت کاربر"""
+        await self.db.execute("UPDATE users SET card_number = ? WHERE user_id = ?", (card_number, user_id))
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            self._put(replace(profile, card_number=card_number))
@@ -0,0 +1,68 @@
+import logging
+import secrets
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_PATH = "/telegram"
+
+
+def create_app(application, secret_token, routes=()):
+    """
+    اپلیکیشن ASGI حالت webhook
+    آپدیت‌های تلگرام در مسیر /telegram مستقیماً در صف آپدیت‌های ربات قرار می‌گیرند و
+    مسیرهای دیگر (مثل /callback درگاه) روی همان حلقه رویداد اجرا می‌شوند.
+    """
+
+    async def telegram(request):
+        # فقط درخواست‌هایی که تلگرام با توکن مخفی ما فرستاده پذیرفته می‌شوند
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(token, secret_token):
+            return Response(status_code=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            logger.error(f"آپدیت نامعتبر از webhook: {e}")
+            return Response(status_code=400)
+        await application.update_queue.put(update)
+        return Response()
+
+    async def health(request):
+        return PlainTextResponse("ok")
+
+    return Starlette(routes=[
+        Route(TELEGRAM_PATH, telegram, methods=["POST"]),
+        Route("/healthz", health, methods=["GET"]),
+        *routes,
+    ])
+
+
+async def run_webhook(application, url, secret_token, routes=(), host="0.0.0.0", port=8443):
+    """
+    اجرای ربات در حالت webhook با یک سرور uvicorn
+    معادل run_polling: post_init پیش از شروع و post_shutdown پس از توقف صدا زده می‌شوند.
+    """
+    server = uvicorn.Server(uvicorn.Config(
+        create_app(application, secret_token, routes), host=host, port=port, log_level="warning"
+    ))
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        try:
+            await application.bot.set_webhook(
+                url=url.rstrip("/") + TELEGRAM_PATH, allowed_updates=Update.ALL_TYPES, secret_token=secret_token
+            )
+            await application.start()
+            logger.info(f"webhook روی {host}:{port} فعال شد.")
+            # uvicorn خودش با SIGINT/SIGTERM متوقف می‌شود
+            await server.serve()
+        finally:
+            if application.running:
+                await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)